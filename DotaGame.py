@@ -1,10 +1,10 @@
+import sys
+import array
 import W3Game
-import json
+import units
 import util
 from collections import defaultdict
 
-UNIT_DATA = json.loads(open("units.json").read())
-
 class Player:
     def __init__(self, id, name, slot):
         self.id = id
@@ -39,12 +39,13 @@ class Player:
 class Hero:
     def __init__(self, id):
         self.id = id
-        if not UNIT_DATA.has_key(self.id):
+        unit = units.get(self.id)
+        if unit is None:
             self.name = "UNKOWN"
             self.icon = "unkown.png"
         else:
-            self.name = UNIT_DATA[self.id]['ProperNames'][0]
-            self.icon = UNIT_DATA[self.id]['Image'][:-4] + ".png"
+            self.name = unit.proper_name or unit.name
+            self.icon = unit.icon
 
     def __repr__(self):
         return "<Hero '%s' (%s)>" % (self.id, self.name)
@@ -52,12 +53,13 @@ class Hero:
 class Item:
     def __init__(self, id):
         self.id = id
-        if not UNIT_DATA.has_key(self.id):
+        unit = units.get(self.id)
+        if unit is None:
             self.name = "UNKOWN"
             self.icon = "unkown.png"
         else:
-            self.name = UNIT_DATA[self.id]['Name']
-            self.icon = UNIT_DATA[self.id]['Image'][:-4] + ".png"
+            self.name = unit.name
+            self.icon = unit.icon
 
     def __repr__(self):
         return "<Item '%s' (%s)>" % (self.id, self.name)
@@ -72,125 +74,260 @@ class Message:
     def __repr__(self):
         return "<Message>"
 
+def timeline_series():
+    return dict((name, array.array('I')) for name in Timeline.SERIES)
+
+class Timeline:
+    # Counts per fixed game time interval, per player (by dota id) and per
+    # team, kept in arrays while the game is aggregated so a curve is read
+    # as is instead of filtering the logs. Arrays end at the last event
+    # until finish() pads them all to the game length.
+    SERIES = ['kills', 'deaths', 'assists', 'towers', 'purchases']
+
+    def __init__(self, interval, teams):
+        self.interval = interval
+        # dota id -> team
+        self.teams = teams
+        self.players = defaultdict(timeline_series)
+        self.by_team = defaultdict(timeline_series)
+        self.length = 0
+
+    def add(self, name, dota_id, time):
+        bucket = time // self.interval
+        self.length = max(self.length, bucket + 1)
+        series = [self.players[dota_id][name]]
+        team = self.teams.get(dota_id)
+        if team is not None:
+            series.append(self.by_team[team][name])
+        for values in series:
+            if len(values) <= bucket:
+                values.extend([0] * (bucket + 1 - len(values)))
+            values[bucket] += 1
+
+    def finish(self, length):
+        # Pads every array to length ms of game time
+        self.length = max(self.length, (length + self.interval - 1) // self.interval)
+        for owners in (self.players, self.by_team):
+            for series in owners.itervalues():
+                for values in series.itervalues():
+                    values.extend([0] * (self.length - len(values)))
+
+    def player(self, dota_id, name):
+        return self.players[dota_id][name] if dota_id in self.players else array.array('I', [0] * self.length)
+
+    def team(self, team, name):
+        return self.by_team[team][name] if team in self.by_team else array.array('I', [0] * self.length)
+
+# Heroes and items never change, so one instance per id is shared by every
+# player and game in the process
+_heroes = {}
+_items = {}
+
+def get_hero(id):
+    hero = _heroes.get(id)
+    if hero is None:
+        hero = _heroes[id] = Hero(id)
+    return hero
+
+def get_item(id):
+    item = _items.get(id)
+    if item is None:
+        item = _items[id] = Item(id)
+    return item
+
+# Keys of the per-player sections
+PLAYER_STATS = {'1': 'kills', '2': 'deaths', '3': 'ckills', '4': 'cdenies',
+                '5': 'assists', '6': 'gold', '7': 'cneutrals', '9': 'hero'}
+
+# Keys of the 'Data' section are one of these followed by a number
+DATA_PREFIXES = ['Mode', 'Hero', 'Assist', 'Level', 'PUI_', 'DRI_', 'Tower']
+
+# Both split once per distinct key, DotaInfo sends the same few hundred
+# keys over and over. Only known keys are kept, other maps can send any
+# number of distinct ones.
+_player_keys = {}
+_data_keys = {}
+
+def player_key(b):
+    # Returns the stat a per-player key sets, 'items' for inventory slots
+    # and None for keys that are ignored
+    try:
+        return _player_keys[b]
+    except KeyError:
+        if b == 'id':
+            act = None
+        elif b.startswith('8_'):
+            act = 'items'
+        else:
+            act = PLAYER_STATS.get(b, '')
+        if act != '':
+            _player_keys[b] = act
+        return act
+
+def data_key(b):
+    # Returns (prefix, rest) of a 'Data' key, prefix is None if unknown
+    try:
+        return _data_keys[b]
+    except KeyError:
+        key = (None, b)
+        for prefix in DATA_PREFIXES:
+            if b.startswith(prefix):
+                key = (prefix, b.replace(prefix, ''))
+                _data_keys[b] = key
+                break
+        return key
+
+def player_info():
+    return defaultdict(list)
+
 class DotaGame:
-    def __init__(self, replay):
-        self.replay = replay
-        self.data = W3Game.W3Game(replay).parse()
+    def __init__(self, replay, data=None, stats=None, timeline_interval=None):
+        # With data (header and gameinfo) given, nothing is parsed and the
+        # events have to be passed to feed(), followed by update_players().
+        # timeline_interval (ms) also builds a Timeline of the game.
+        # Only the file name is kept, replay data given in memory would be
+        # carried along in every pickled result; None for such data
+        game = None
+        if data is None:
+            game = W3Game.W3Game(replay, stats)
+            self.replayfile = game.replayfile
+            data = game.parse_gameinfo()
+        elif isinstance(replay, basestring) and not replay.startswith(W3Game.MAGIC):
+            self.replayfile = replay
+        else:
+            self.replayfile = None
+        self.data = data
 
         self.gamename = self.data['gameinfo']['gamename']
         self.mode = ""
 
         self.players = []
+        self.players_by_id = {}
+        self.players_by_dota_id = {}
         for player in self.data['gameinfo']['players']:
             plr = Player(player['id'], player['name'], player['slot'])
             self.players.append(plr)
-        
+            self.players_by_id[plr.id] = plr
+            self.players_by_dota_id[plr.dota_id] = plr
+
         self.messages = []
-        for gd in self.data['gamedata']:
-            if not isinstance(gd, dict) or gd['type'] != "CHATMESSAGE":
-                continue
-            message = Message(self.get_player(gd['data']['player_id']), gd['data']['message'], gd['data']['mode'], gd['time'])
-            self.messages.append(message)
-            message.player.messages.append(message)
+        self.info = defaultdict(player_info)
+        self.timeline = None
+        if timeline_interval:
+            self.timeline = Timeline(timeline_interval, dict((plr.dota_id, plr.slot['team']) for plr in self.players))
 
-        self.parse_dotainfo()
+        if game is None:
+            return
 
-        for player in self.players:
-            print player.name, player.items
+        # Single pass over the gamedata, nothing but chat and DotaInfo is kept
+        try:
+            for event in game.iter_events(actions=['DotaInfo']):
+                self.feed(event)
+        except W3Game.ReplayError, e:
+            # Stats up to the broken part are the partial result
+            self.update_players()
+            e.partial = self
+            raise
+        finally:
+            game.close()
+
+        self.update_players()
 
     def get_dotaplayer(self, pid):
-        for player in self.players:
-            if player.dota_id == pid:
-                return player
+        return self.players_by_dota_id.get(pid)
 
     def get_player(self, pid):
-        for player in self.players:
-            if player.id == pid:
-                return player
-        return
+        return self.players_by_id.get(pid)
 
     def find_player(self, s):
         for player in self.players:
             if player.name.lower() == s.lower():
                 return player
 
-    def parse_dotainfo(self):
-        # TODO: Parse timed actions and inventory/abilities.
-        info = defaultdict(lambda: defaultdict(list))
-        for gd in self.data['gamedata']:
-            if not isinstance(gd, dict) or gd['type'] != "TIMESLOT":
-                continue
-            for command_block in gd['data']['command_blocks']:
+    def feed(self, event):
+        if not isinstance(event, dict):
+            return
+        if event['type'] == "CHATMESSAGE":
+            message = Message(self.get_player(event['data']['player_id']), event['data']['message'], event['data']['mode'], event['time'])
+            self.messages.append(message)
+            message.player.messages.append(message)
+        elif event['type'] == "TIMESLOT":
+            for command_block in event['data']['command_blocks']:
                 for action in command_block['actions']:
                     if not isinstance(action, dict) or action['name'] != "DotaInfo":
                         continue
-                    a, b, c = action['data']['strings']
-
-                    if a == 'Data':
-                        if b.startswith('Mode'):
-                            data = b.replace('Mode', '')
-                            self.mode = data
-                        elif b.startswith('Hero'):
-                            data = b.replace('Hero', '')
-                            player_id = int(c)
-                            victim_id = int(data)
-                            info[player_id]['kill_log'].append({'time': gd['time'], 'victim': self.get_dotaplayer(victim_id)})
-                            info[victim_id]['death_log'].append({'time': gd['time'], 'killer': self.get_dotaplayer(player_id)})
-                        elif b.startswith('Assist'):
-                            data = b.replace('Assist', '')
-                            player_id = int(data)
-                            victim_id = int(c)
-                            info[player_id]['assist_log'].append({'time': gd['time'], 'victim': self.get_dotaplayer(victim_id)})
-                        elif b.startswith('Level'):
-                            data = b.replace('Level', '')
-                        elif b.startswith('PUI_'):
-                            data = b.replace('PUI_', '')
-                            player_id = int(data)
-                            item = Item(c)
-                            info[player_id]['item_log'].append({'time': gd['time'], 'action': 'purchase', 'item': item})
-                        elif b.startswith('DRI_'):
-                            data = b.replace('DRI_', '')
-                            player_id = int(data)
-                            item = Item(c)
-                            info[player_id]['item_log'].append({'time': gd['time'], 'action': 'drop', 'item': item})
-                        elif b.startswith('Tower'):
-                            # TODO: Read Team/Lane/Number information from tower (b=Team(0/1)/Number(1/2/3/4)/Lane(0/1/2))
-                            player_id = int(c)
-                            if not info[player_id]['towers']:
-                                info[player_id]['towers'] = 0
-                            info[player_id]['towers'] += 1
-                            info[player_id]['tower_log'].append({'time': gd['time']})
-                    elif a.isdigit():
-                        player_id = int(a)
-                        data = c
-                        act = ''
-
-                        if b == '1':
-                            act = 'kills'
-                        elif b == '2':
-                            act = 'deaths'
-                        elif b == '3':
-                            act = 'ckills'
-                        elif b == '4':
-                            act = 'cdenies'
-                        elif b == '5':
-                            act = 'assists'
-                        elif b == '6':
-                            act = 'gold'
-                        elif b == '7':
-                            act = 'cneutrals'
-                        elif b == '9':
-                            act = 'hero'
-                        elif b == 'id':
-                            continue
-                        elif b.startswith('8_'):
-                            act = 'items'
-                            if data:
-                                info[player_id][act].append(Item(data))
-                            continue
-
-                        info[player_id][act] = data
+                    self.parse_dotainfo(event['time'], action['data']['strings'])
+
+    def parse_dotainfo(self, time, strings):
+        # TODO: Parse timed actions and inventory/abilities.
+        a, b, c = strings
+
+        if a == 'Data':
+            prefix, data = data_key(b)
+            handler = self.data_handlers.get(prefix)
+            if handler is not None:
+                handler(self, time, data, c)
+        elif a.isdigit():
+            act = player_key(b)
+            if act is None:
+                return
+            player_id = int(a)
+            if act == 'items':
+                if c:
+                    self.info[player_id][act].append(get_item(c))
+                return
+            self.info[player_id][act] = c
+
+    def handleMode(self, time, data, c):
+        self.mode = data
+
+    def handleHeroKill(self, time, data, c):
+        player_id = int(c)
+        victim_id = int(data)
+        self.info[player_id]['kill_log'].append({'time': time, 'victim': self.get_dotaplayer(victim_id)})
+        self.info[victim_id]['death_log'].append({'time': time, 'killer': self.get_dotaplayer(player_id)})
+        if self.timeline is not None:
+            self.timeline.add('kills', player_id, time)
+            self.timeline.add('deaths', victim_id, time)
+
+    def handleAssist(self, time, data, c):
+        player_id = int(data)
+        victim_id = int(c)
+        self.info[player_id]['assist_log'].append({'time': time, 'victim': self.get_dotaplayer(victim_id)})
+        if self.timeline is not None:
+            self.timeline.add('assists', player_id, time)
+
+    def handlePurchase(self, time, data, c):
+        self.info[int(data)]['item_log'].append({'time': time, 'action': 'purchase', 'item': get_item(c)})
+        if self.timeline is not None:
+            self.timeline.add('purchases', int(data), time)
+
+    def handleDrop(self, time, data, c):
+        self.info[int(data)]['item_log'].append({'time': time, 'action': 'drop', 'item': get_item(c)})
+
+    def handleTower(self, time, data, c):
+        # TODO: Read Team/Lane/Number information from tower (b=Team(0/1)/Number(1/2/3/4)/Lane(0/1/2))
+        player_id = int(c)
+        info = self.info[player_id]
+        if not info['towers']:
+            info['towers'] = 0
+        info['towers'] += 1
+        info['tower_log'].append({'time': time})
+        if self.timeline is not None:
+            self.timeline.add('towers', player_id, time)
+
+    # Plain functions, bound methods would keep games from being pickled
+    data_handlers = {'Mode':   handleMode,
+                     'Hero':   handleHeroKill,
+                     'Assist': handleAssist,
+                     'PUI_':   handlePurchase,
+                     'DRI_':   handleDrop,
+                     'Tower':  handleTower}
 
+    def update_players(self):
+        info = self.info
+        if self.timeline is not None:
+            self.timeline.finish(self.data['header']['length'])
         for player in self.players:
             player.kills = info[player.dota_id]['kills']
             player.deaths = info[player.dota_id]['deaths']
@@ -200,7 +337,10 @@ class DotaGame:
             player.cdenies = info[player.dota_id]['cdenies']
             player.cneutrals = info[player.dota_id]['cneutrals']
             player.gold = info[player.dota_id]['gold']
-            player.hero = Hero(info[player.dota_id]['hero'])
+            hero = info[player.dota_id]['hero']
+            # The hero is only reported at the end of the game, until then
+            # (and for players who never picked one) it is None
+            player.hero = get_hero(hero) if hero else None
             player.kill_log = info[player.dota_id]['kill_log']
             player.death_log = info[player.dota_id]['death_log']
             player.assist_log = info[player.dota_id]['assist_log']
@@ -212,4 +352,7 @@ class DotaGame:
             if player.towers == []:
                 player.towers = 0
 
-DotaGame("/home/mephory/g.w3g")
+if __name__ == '__main__':
+    game = DotaGame(sys.argv[1])
+    for player in game.players:
+        print player.name, player.items
@@ -1,7 +1,14 @@
 import sys
-from cStringIO import StringIO
+import mmap
+import time
 import zlib
 import struct
+import multiprocessing
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+# Bump whenever the parsed output changes, cached results depend on it
+PARSER_VERSION = 5
 
 def decompress(data):
     dc = zlib.decompressobj(-zlib.MAX_WBITS)
@@ -9,29 +16,469 @@ def decompress(data):
     decomp_data += dc.flush()
     return decomp_data
 
+_structs = {}
+
+def get_struct(fmt):
+    # Precompiled Struct objects keyed by format string; read() is called
+    # several times per action, so building them once matters.
+    try:
+        return _structs[fmt]
+    except KeyError:
+        st = _structs[fmt] = struct.Struct(fmt)
+        return st
+
+MAGIC = "Warcraft III recorded game\x1A\0"
+HEADER = struct.Struct("28sIIIII4sIHHII")
+BLOCK_HEADER = struct.Struct("HHI")
+
+# Fixed-size actions: id -> (name, payload format, exposed fields). These are
+# decoded straight from this table with a single unpack; the fields name
+# the leading values of the payload that end up in the action's data.
+FIXED_ACTIONS = {'\x01': ('PauseGame',         '',      ()),
+                 '\x02': ('ResumeGame',        '',      ()),
+                 '\x03': ('SetGamespeed',      'c',     ('speed',)),
+                 '\x04': ('IncreaseGamespeed', '',      ()),
+                 '\x05': ('DecreaseGamespeed', '',      ()),
+                 '\x07': ('SaveGameFinished',  '<I',    ()),
+                 '\x10': ('UnitAbility',       '<HIII', ()),
+                 '\x11': ('UnitAbilityTargetPosition', '<HIIIff', ()),
+                 '\x12': ('UnitAbilityTargetPositionAndObject', '<HIIIffII', ()),
+                 '\x13': ('DropItem',          '<HIIIffIIII', ()),
+                 '\x14': ('UnitAbilityTargetTwoPositionsAndObjects', '<HIIIffI9sff', ()),
+                 '\x18': ('SelectGroupHotkey', '<BB',   ('group_number',)),
+                 '\x19': ('SelectSubgroup',    '<III',  ()),
+                 '\x1A': ('UpdateSubgroup',    '',      ()),
+                 '\x1C': ('SelectGroundItem',  '<BII',  ()),
+                 '\x1D': ('CancelHeroRevival', '<II',   ()),
+                 '\x1E': ('RemoveUnitFromBuildingQueue', '<BI', ()),
+                 '\x50': ('ChangeAllyOptions', '<BI',   ()),
+                 '\x51': ('TransferResources', '<BII',  ()),
+                 '\x61': ('EscPressed',        '',      ()),
+                 '\x66': ('EnterSkillMenu',    '',      ()),
+                 '\x67': ('EnterBuildingsMenu', '',     ()),
+                 '\x68': ('MinimapSignal',     '<III',  ('x', 'y')),
+                 '\x69': ('ContinueGame',      '<IIII', ()),
+                 '\x6A': ('ContinueGame',      '<IIII', ())}
+FIXED_ACTIONS = dict((a_id, (name, get_struct(fmt), fields)) for a_id, (name, fmt, fields) in FIXED_ACTIONS.items())
+
+# Payload sizes of the actions that can be seeked past when they are
+# filtered out. Variable-length actions are missing here and are always
+# decoded.
+ACTION_SIZES = dict((a_id, fmt.size) for a_id, (name, fmt, fields) in FIXED_ACTIONS.items())
+ACTION_SIZES.update({'\x1B': 9, '\x20': 0, '\x21': 8, '\x22': 0, '\x23': 0, '\x24': 0,
+                     '\x25': 0, '\x26': 0, '\x27': 5, '\x28': 5, '\x29': 0, '\x2A': 0,
+                     '\x2B': 0, '\x2C': 0, '\x2D': 5, '\x2E': 4, '\x2F': 0, '\x30': 0,
+                     '\x31': 0, '\x32': 0, '\x62': 12, '\x75': 1})
+
+class ReplayError(Exception):
+    # Raised for replay data the parser can't make sense of. parse() fills
+    # in partial with what was decoded up to that point.
+    def __init__(self, message):
+        Exception.__init__(self, message)
+        self.partial = None
+
+class UnknownAction(ReplayError):
+    def __init__(self, a_id, position, context):
+        ReplayError.__init__(self, "Unexpected action block %r at %d (surrounding bytes %r)" % (a_id, position, context))
+        self.a_id = a_id
+        self.position = position
+
+class UnknownBlock(ReplayError):
+    def __init__(self, block_id, position, context):
+        ReplayError.__init__(self, "Unexpected gamedata block %r at %d (surrounding bytes %r)" % (block_id, position, context))
+        self.block_id = block_id
+        self.position = position
+
+class TruncatedReplay(ReplayError):
+    pass
+
+class CorruptReplay(ReplayError):
+    pass
+
+class Record(object):
+    # Compact replacement for the event/action dicts. Supports the dict
+    # style lookups (record['name']) the rest of the code uses.
+    __slots__ = ()
+
+    def __init__(self, *values):
+        for key, value in zip(self.__slots__, values):
+            setattr(self, key, value)
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def keys(self):
+        return list(self.__slots__)
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.__getstate__() == other.__getstate__()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __getstate__(self):
+        return tuple(getattr(self, key) for key in self.__slots__)
+
+    def __setstate__(self, state):
+        for key, value in zip(self.__slots__, state):
+            setattr(self, key, value)
+
+    def __repr__(self):
+        return "<%s %s>" % (self.__class__.__name__, " ".join("%s=%r" % (key, getattr(self, key)) for key in self.__slots__))
+
+class Event(Record):
+    __slots__ = ('type', 'time', 'data')
+
+class CommandBlock(Record):
+    __slots__ = ('player_id', 'actions', 'size')
+
+class Action(Record):
+    __slots__ = ('name', 'data')
+
+class EmptyData(dict):
+    # Data of the shared payload-less actions below; one instance is shared
+    # by every compact parse, so it refuses to be filled in
+    __slots__ = ()
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError("Shared action data is read-only, copy it first")
+
+    __setitem__ = __delitem__ = update = setdefault = pop = popitem = clear = _immutable
+
+_empty_data = EmptyData()
+
+# Actions without payload (EscPressed, UpdateSubgroup, ...) are shared
+# between all compact parses; their data can't be changed, and callers
+# must not reassign their attributes either
+_empty_actions = {}
+
+def compact_action(action):
+    if action['data']:
+        return Action(action['name'], action['data'])
+    try:
+        return _empty_actions[action['name']]
+    except KeyError:
+        record = _empty_actions[action['name']] = Action(action['name'], _empty_data)
+        return record
+
+class ParseStats:
+    # Counters filled in by a parse when passed as W3Game(..., stats=...).
+    # Block and action entries are [count, bytes, seconds]; a block's time
+    # includes the actions decoded inside it. inflate holds
+    # (compressed bytes, inflated bytes, seconds) per data block.
+    def __init__(self):
+        self.blocks = {}
+        self.actions = {}
+        self.inflate = []
+
+    def add(self, table, name, size, elapsed):
+        entry = table.get(name)
+        if entry is None:
+            entry = table[name] = [0, 0, 0.0]
+        entry[0] += 1
+        entry[1] += size
+        entry[2] += elapsed
+
+    def add_block(self, name, size, elapsed):
+        self.add(self.blocks, name, size, elapsed)
+
+    def add_action(self, name, size, elapsed):
+        self.add(self.actions, name, size, elapsed)
+
+    def add_inflate(self, compressed_size, decompressed_size, elapsed):
+        self.inflate.append((compressed_size, decompressed_size, elapsed))
+
+    def merge(self, other):
+        for table, others in ((self.blocks, other.blocks), (self.actions, other.actions)):
+            for name, (count, size, elapsed) in others.iteritems():
+                entry = table.setdefault(name, [0, 0, 0.0])
+                entry[0] += count
+                entry[1] += size
+                entry[2] += elapsed
+        self.inflate.extend(other.inflate)
+
+    def report(self):
+        lines = []
+        for title, table in (("Blocks", self.blocks), ("Actions", self.actions)):
+            lines.append("%s:" % title)
+            for name, (count, size, elapsed) in sorted(table.items(), key=lambda item: -item[1][2]):
+                lines.append("  %-40s %8d x %10d bytes %9.1fms" % (name, count, size, elapsed * 1000))
+        lines.append("Inflate: %d blocks, %d -> %d bytes, %.1fms" % (len(self.inflate),
+                                                                   sum(entry[0] for entry in self.inflate),
+                                                                   sum(entry[1] for entry in self.inflate),
+                                                                   sum(entry[2] for entry in self.inflate) * 1000))
+        return "\n".join(lines)
+
+class BlockReader:
+    # File-like cursor over the data blocks of a replay. Blocks are inflated
+    # one at a time when a read runs past the current one, so seeking only
+    # works within the data inflated since the last block boundary.
+    def __init__(self, replay, num_blocks, stats=None):
+        self.replay = replay
+        self.blocks_left = num_blocks
+        self.buffer = ''
+        self.offset = 0
+        self.pos = 0
+        # Data from this stream position on is kept even once consumed
+        self.mark = None
+        # (block number, stream position, file position) of the last two
+        # blocks, to map stream positions back to blocks
+        self.block_number = -1
+        self.block_file_pos = None
+        self.current_block = self.previous_block = None
+
+        # Profiling swaps in instrumented methods, so it costs nothing
+        # when disabled
+        self.stats = stats
+        if stats is not None:
+            self.inflate = self.profiled_inflate
+
+    def next_block(self):
+        if not self.blocks_left:
+            return None
+        self.block_file_pos = self.replay.tell()
+        header = self.replay.read(BLOCK_HEADER.size)
+        if len(header) < BLOCK_HEADER.size:
+            raise TruncatedReplay("Replay ends in the header of the data block at %d" % self.block_file_pos)
+        compressed_size, decompressed_size, checksum = BLOCK_HEADER.unpack(header)
+        data = self.replay.read(compressed_size)
+        if len(data) < compressed_size:
+            raise TruncatedReplay("Replay ends in the data block at %d" % self.block_file_pos)
+        self.blocks_left -= 1
+        return self.inflate(data)
+
+    def inflate(self, data):
+        # Skip the two byte zlib header, blocks are inflated as raw deflate.
+        # buffer() skips it without copying the payload.
+        try:
+            return decompress(buffer(data, 2))
+        except zlib.error, e:
+            raise CorruptReplay("Data block can't be inflated: %s" % e)
+
+    def profiled_inflate(self, data):
+        start = time.time()
+        block = BlockReader.inflate(self, data)
+        self.stats.add_inflate(len(data), len(block), time.time() - start)
+        return block
+
+    def fill(self):
+        block = self.next_block()
+        if block is None:
+            return False
+
+        # Drop everything that has already been consumed
+        keep = self.pos
+        if self.mark is not None:
+            keep = min(keep, self.mark - self.offset)
+        self.buffer = self.buffer[keep:] + block
+        self.offset += keep
+        self.pos -= keep
+
+        self.block_number += 1
+        self.previous_block = self.current_block
+        self.current_block = (self.block_number, self.offset + len(self.buffer) - len(block), self.block_file_pos)
+        return True
+
+    def locate(self, position):
+        # Returns (block number, file position of the block, offset inside
+        # the block) for a position in the current or previous block.
+        for block in (self.current_block, self.previous_block):
+            if block is not None and position >= block[1]:
+                return block[0], block[2], position - block[1]
+        raise IOError("Position %d is not in the current blocks" % position)
+
+    def read(self, length):
+        while self.pos + length > len(self.buffer) and self.fill():
+            pass
+        data = self.buffer[self.pos:self.pos + length]
+        self.pos += len(data)
+        return data
+
+    def skip(self, length):
+        while self.pos + length > len(self.buffer) and self.fill():
+            pass
+        self.pos = min(self.pos + length, len(self.buffer))
+
+    def unpack(self, fmt):
+        # Unpacks straight from the inflated block, without slicing out an
+        # intermediate string first.
+        while self.pos + fmt.size > len(self.buffer) and self.fill():
+            pass
+        try:
+            values = fmt.unpack_from(self.buffer, self.pos)
+        except struct.error:
+            raise TruncatedReplay("Replay data ends in a %d byte field at %d" % (fmt.size, self.tell()))
+        self.pos += fmt.size
+        return values
+
+    def read_string(self):
+        # Find the terminator and slice once instead of reading byte by byte
+        start = self.pos
+        end = self.buffer.find('\0', start)
+        while end == -1:
+            searched = len(self.buffer) - self.pos
+            if not self.fill():
+                end = len(self.buffer)
+                break
+            start = self.pos
+            end = self.buffer.find('\0', start + searched)
+
+        s = self.buffer[start:end]
+        self.pos = min(end + 1, len(self.buffer))
+        return s
+
+    def tell(self):
+        return self.offset + self.pos
+
+    def seek(self, position):
+        if not self.offset <= position <= self.offset + len(self.buffer):
+            raise IOError("Cannot seek to %d, outside of the current block" % position)
+        self.pos = position - self.offset
+
+    def close(self):
+        pass
+
+class ParallelBlockReader(BlockReader):
+    # BlockReader that maps the file, walks all block headers up front and
+    # inflates the blocks on a thread pool, a few chunks of blocks ahead of
+    # the reader. Every block is a zlib stream of its own and zlib releases
+    # the GIL while inflating, so this scales with cores. Blocks are still
+    # handed out in order.
+    def __init__(self, replay, num_blocks, stats=None, threads=None, chunksize=32):
+        BlockReader.__init__(self, replay, num_blocks, stats)
+        if isinstance(replay, MappedReplay):
+            self.map = replay.data
+        else:
+            self.map = mmap.mmap(replay.fileno(), 0, access=mmap.ACCESS_READ)
+        self.blocks = self.read_block_headers(replay.tell(), num_blocks)
+        # Fewer complete blocks than the header promises
+        self.truncated = len(self.blocks) < num_blocks
+        threads = threads or multiprocessing.cpu_count()
+        self.pool = ThreadPool(threads)
+        # Blocks are small, so they are handed to the pool in chunks to
+        # keep the per-task overhead down. ahead bounds the chunks held
+        # in memory.
+        self.chunksize = chunksize
+        self.ahead = 2 * threads
+        self.pending = deque()
+        self.chunk = deque()
+        self.queued = 0
+
+    def read_block_headers(self, position, num_blocks):
+        # (file position, payload start, payload end) per complete block
+        blocks = []
+        for i in range(num_blocks):
+            start = position + BLOCK_HEADER.size
+            if start > len(self.map):
+                break
+            compressed_size = BLOCK_HEADER.unpack_from(self.map, position)[0]
+            if start + compressed_size > len(self.map):
+                break
+            blocks.append((position, start, start + compressed_size))
+            position = start + compressed_size
+        return blocks
+
+    def inflate_chunk(self, payloads):
+        return [self.inflate(data) for data in payloads]
+
+    def next_block(self):
+        while self.queued < len(self.blocks) and len(self.pending) < self.ahead:
+            blocks = self.blocks[self.queued:self.queued + self.chunksize]
+            payloads = [buffer(self.map, start, end - start) for file_pos, start, end in blocks]
+            self.pending.append((blocks, self.pool.apply_async(self.inflate_chunk, (payloads,))))
+            self.queued += len(blocks)
+
+        if not self.chunk:
+            if not self.pending:
+                self.close()
+                if self.truncated:
+                    raise TruncatedReplay("Replay ends after %d complete data blocks" % len(self.blocks))
+                return None
+            blocks, result = self.pending.popleft()
+            self.chunk.extend(zip([file_pos for file_pos, start, end in blocks], result.get()))
+
+        self.block_file_pos, block = self.chunk.popleft()
+        self.blocks_left -= 1
+        return block
+
+    def close(self):
+        if self.pool is not None:
+            # Not terminate(), which waits on the pool's polling threads;
+            # at most ahead chunks are left to finish on their own
+            self.pool.close()
+            self.pool = None
+            # Those chunks still hold buffers into the map, it is unmapped
+            # once the last one is gone
+            self.map = None
+
+class MappedReplay:
+    # Read-only file-like view of replay data held in memory: a string, a
+    # buffer or a mapped file. read() returns buffer slices sharing that
+    # memory, so headers and compressed blocks are never copied.
+    def __init__(self, data, file=None):
+        self.data = data
+        self.file = file
+        self.pos = 0
+
+    def read(self, length):
+        data = buffer(self.data, self.pos, length)
+        self.pos += len(data)
+        return data
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, position):
+        self.pos = position
+
+    def close(self):
+        # Buffers handed out may outlive this, so the map is not closed
+        # explicitly; it goes away with the last reference
+        self.data = None
+        if self.file is not None:
+            self.file.close()
+
+def map_file(filename):
+    f = open(filename, 'rb')
+    return MappedReplay(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ), f)
+
 class W3Game:
-    def __init__(self, filename):
-        self.replayfile = filename
-        self.data = open(self.replayfile)
+    def __init__(self, filename, stats=None, threads=None, mapped=False):
+        # filename may also be the replay data itself, as a string or
+        # buffer, to parse uploads without touching the disk. mapped reads
+        # a file through mmap instead of read() calls.
+        if isinstance(filename, basestring) and not filename.startswith(MAGIC):
+            self.replayfile = filename
+            if mapped:
+                self.replay = map_file(filename)
+            else:
+                self.replay = open(self.replayfile, 'rb')
+        else:
+            self.replayfile = None
+            self.replay = MappedReplay(filename)
+        self.data = self.replay
         self.info = {}
+        self.stats = stats
+        # Inflate data blocks on this many threads, serially if None
+        self.threads = threads
         
     def read(self, length):
         if isinstance(length, str):
-            fmt = struct.Struct(length)
-            return fmt.unpack(self.data.read(fmt.size))
+            return self.data.unpack(get_struct(length))
         return self.data.read(length)
 
     def read_string(self):
-        s = ''
-        c = self.read(1)
-        while c != '\0':
-            s += c
-            c = self.read(1)
-        return s
+        return self.data.read_string()
 
     def read_header(self):
         keys = "id size compressed_size version decompressed_size num_datablocks w3_version w3_version_number build_number is_multiplayer length checksum".split()
-        header = dict(zip(keys, self.read("28sIIIII4sIHHII")))
+        header = dict(zip(keys, HEADER.unpack(self.data.read(HEADER.size))))
 
         # Convert values
         header['is_multiplayer'] = header['is_multiplayer'] != '\0\0' 
@@ -102,28 +549,103 @@ class W3Game:
         gameinfo['num_startspots'] = ord(self.read(1))
         return gameinfo
 
-    def parse(self):
+    def block_reader(self, num_blocks):
+        if self.threads:
+            return ParallelBlockReader(self.replay, num_blocks, self.stats, self.threads)
+        return BlockReader(self.replay, num_blocks, self.stats)
+
+    def parse_gameinfo(self, metadata_only=False):
         self.info['header'] = self.read_header()
 
-        io = StringIO()
-        for i in range(self.info['header']['num_datablocks']):
-            compressed_size, decompressed_size, checksum = self.read("HHI")
-            io.write(decompress(self.read(compressed_size)[2:]))
-        io.seek(4)
-        self.data = io
+        num_blocks = self.info['header']['num_datablocks']
+        if metadata_only:
+            # The game info is in the first block or two, a thread pool
+            # inflating blocks ahead would only waste work
+            self.data = BlockReader(self.replay, num_blocks, self.stats)
+        else:
+            self.data = self.block_reader(num_blocks)
+        self.data.read(4)
 
         self.info['gameinfo'] = self.read_gameinfo()
+        return self.info
 
-        data_reader = ReplayDataReader(self.data)
-
-        self.info['gamedata'] = data_reader.parse()
+    def iter_events(self, actions=None, compact=False, index=None):
+        if not self.info.has_key('gameinfo'):
+            self.parse_gameinfo()
+        return ReplayDataReader(self.data, actions, compact, index, self.stats).iter_events()
 
+    def iter_events_between(self, start, end, index, actions=None, compact=False):
+        # Decodes only the events between the game times start and end (ms),
+        # starting from the closest TimeIndex entry instead of the beginning.
+        self.info['header'] = self.read_header()
+        if index.checksum != self.info['header']['checksum']:
+            raise ValueError("Time index does not belong to %s" % self.replayfile)
+
+        time, block_number, file_pos, offset = index.lookup(start)
+        self.replay.seek(file_pos)
+        self.data = self.block_reader(self.info['header']['num_datablocks'] - block_number)
+        self.data.skip(offset)
+
+        reader = ReplayDataReader(self.data, actions, compact, stats=self.stats)
+        reader.time = time
+        for event in reader.iter_events():
+            if event['time'] > end:
+                break
+            if event['time'] >= start:
+                yield event
+
+    def iter_actions(self, actions=None, compact=False, index=None):
+        if not self.info.has_key('gameinfo'):
+            self.parse_gameinfo()
+        return ReplayDataReader(self.data, actions, compact, index, self.stats).iter_actions()
+
+    def iter_raw_actions(self, actions=None):
+        if not self.info.has_key('gameinfo'):
+            self.parse_gameinfo()
+        return ReplayDataReader(self.data, actions, stats=self.stats).iter_raw_actions()
+
+    def parse(self, actions=None, metadata_only=False, compact=False, index=None):
+        # metadata_only stops after the game info, which usually sits in
+        # the first data block, and never touches the rest of the file.
+        if metadata_only:
+            self.parse_gameinfo(metadata_only=True)
+            self.close()
+            return self.info
+
+        # A replay that breaks off still yields the events before the
+        # break, as the partial result of the ReplayError
+        events = []
+        try:
+            # extend() keeps the events it got before an exception
+            events.extend(self.iter_events(actions, compact, index))
+        except ReplayError, e:
+            self.info['gamedata'] = events
+            e.partial = self.info
+            raise
+        finally:
+            self.close()
+        self.info['gamedata'] = events
         return self.info
 
+    def close(self):
+        if self.data is not self.replay:
+            self.data.close()
+        self.replay.close()
+
 class ReplayDataReader:
-    def __init__(self, data):
+    def __init__(self, data, actions=None, compact=False, index=None, stats=None):
         self.data = data
         self.time = 0
+        # TimeIndex to record TimeSlot positions in, if any
+        self.index = index
+        # ParseStats to fill in, instrumented methods are only swapped in
+        # when profiling so the default path stays untouched
+        self.stats = stats
+        if stats is not None:
+            self.read_event = self.profiled_read_event
+            self.parse_action_block = self.profiled_parse_action_block
+        # Build Event/CommandBlock/Action records instead of dicts
+        self.compact = compact
         self.blocks = {'\x17': ('LeaveGame',   self.handleLeaveGame),
                        '\x1A': ('Unkown',      self.skip(4)),
                        '\x1B': ('Unkown',      self.skip(4)), 
@@ -135,27 +657,28 @@ class ReplayDataReader:
                        '\x23': ('Unkown',      self.skip(10)), 
                        '\x2F': ('ForceGameEnd',self.handleForceGameEnd)}
 
-        self.action_blocks = {'\x01': ('PauseGame',    self.handlePauseGame), 
-                               '\x02': ('ResumeGame',   self.handleResumeGame), 
-                               '\x03': ('SetGamespeed', self.handleSetGamespeed), 
-                               '\x04': ('IncrGamespeed',self.handleIncrGamespeed), 
-                               '\x05': ('DecrGamespeed',self.handleDecrGamespeed), 
+        # Actions without a handler are decoded from FIXED_ACTIONS
+        self.action_blocks = {'\x01': ('PauseGame',    None), 
+                               '\x02': ('ResumeGame',   None), 
+                               '\x03': ('SetGamespeed', None), 
+                               '\x04': ('IncrGamespeed',None), 
+                               '\x05': ('DecrGamespeed',None), 
                                '\x06': ('SaveGame',     self.handleSaveGame),
-                               '\x07': ('SaveGameFinished', self.handleSaveGameFinished),
-                               '\x10': ('UnitAbility',  self.handleUnitAbility),
-                               '\x11': ('UnitAbilityTargetPos', self.handleUnitAbilityTargetPos),
-                               '\x12': ('UnitAbilityTargetPosObj', self.handleUnitAbilityTargetPosObj),
-                               '\x13': ('DropItem',     self.handleDropItem),
-                               '\x14': ('UnitAbilityTargetTwoPosObj', self.handleUnitAbilityTargetTwoPosObj),
+                               '\x07': ('SaveGameFinished', None),
+                               '\x10': ('UnitAbility',  None),
+                               '\x11': ('UnitAbilityTargetPos', None),
+                               '\x12': ('UnitAbilityTargetPosObj', None),
+                               '\x13': ('DropItem',     None),
+                               '\x14': ('UnitAbilityTargetTwoPosObj', None),
                                '\x16': ('ChangeSelection', self.handleChangeSelection),
                                '\x17': ('AssignGroupHotkey', self.handleAssignGroupHotkey),
-                               '\x18': ('SelectGroupHotkey', self.handleSelectGroupHotkey),
-                               '\x19': ('SelectSubgroup', self.handleSelectSubgroup),
-                               '\x1A': ('UpdateSubgroup', self.handleUpdateSubgroup),
+                               '\x18': ('SelectGroupHotkey', None),
+                               '\x19': ('SelectSubgroup', None),
+                               '\x1A': ('UpdateSubgroup', None),
                                '\x1B': ('Unknown',       self.skip(9)),
-                               '\x1C': ('SelectGroundItem', self.handleSelectGroundItem),
-                               '\x1D': ('CancelHeroRevival', self.handleCancelHeroRevival),
-                               '\x1E': ('RemoveUnitFromBuildingQueue', self.handleRemoveUnitFromBuildingQueue),
+                               '\x1C': ('SelectGroundItem', None),
+                               '\x1D': ('CancelHeroRevival', None),
+                               '\x1E': ('RemoveUnitFromBuildingQueue', None),
                                '\x21': ('Unknown',      self.skip(8)),
                                '\x20': ('Cheat1',       self.skip(0)),
                                '\x22': ('Cheat2',       self.skip(0)),
@@ -175,26 +698,45 @@ class ReplayDataReader:
                                '\x30': ('Cheat16',      self.skip(0)),
                                '\x31': ('Cheat17',      self.skip(0)),
                                '\x32': ('Cheat18',      self.skip(0)),
-                               '\x50': ('ChangeAllyOptions', self.handleChangeAllyOptions),
-                               '\x51': ('TransferResources', self.handleTransferResources),
+                               '\x50': ('ChangeAllyOptions', None),
+                               '\x51': ('TransferResources', None),
                                '\x60': ('MapTriggerChatCommand', self.handleMapTriggerChatCommand),
-                               '\x61': ('EscPressed', self.handleEscPressed),
+                               '\x61': ('EscPressed', None),
                                '\x62': ('unknown',       self.skip(12)),
-                               '\x66': ('EnterSkillMenu', self.handleEnterSkillMenu),
-                               '\x67': ('EnterBuildingsMenu', self.handleEnterBuildingsMenu),
-                               '\x68': ('MinimapSignal', self.handleMinimapSignal),
-                               '\x69': ('ContinueGame', self.handleContinueGame),
-                               '\x6A': ('ContinueGameB', self.handleContinueGame),
+                               '\x66': ('EnterSkillMenu', None),
+                               '\x67': ('EnterBuildingsMenu', None),
+                               '\x68': ('MinimapSignal', None),
+                               '\x69': ('ContinueGame', None),
+                               '\x6A': ('ContinueGameB', None),
                                '\x75': ('unknown', self.skip(1)), 
                                '\x6B': ('DotaInfo', self.handleDotaInfo)}   # DOTA
+
+        # Only decode the given action names/ids, None decodes everything
+        self.wanted = None
+        if actions is not None:
+            self.wanted = set()
+            for action in actions:
+                if self.action_blocks.has_key(action):
+                    self.wanted.add(action)
+                    continue
+                # Names are looked up in action_blocks and, for fixed-size
+                # actions, as decoded actions carry them; a name can stand
+                # for several ids
+                ids = [a_id for a_id, (name, handler) in self.action_blocks.items() if name == action]
+                ids += [a_id for a_id, (name, fmt, fields) in FIXED_ACTIONS.items() if name == action]
+                if not ids:
+                    raise ValueError("Unknown action %r" % action)
+                self.wanted.update(ids)
                               
 
     # GAMEDATA BLOCKS
     def handleLeaveGame(self):
-        reason, player_id, result, nothing = self.read("IBII")
+        reason, player_id, result, nothing = self.read("<IBII")
         return {'type': 'LEAVEGAME', 'time': self.time, 'data': {'reason': reason, 'player_id': player_id, 'result': result}}
 
     def handleTimeSlot(self):
+        if self.index is not None:
+            self.index.add(self.time, self.data.locate(self.data.tell() - 1))
         num_bytes, time_increment = self.read("<HH")
         command_blocks = []
         self.time += time_increment
@@ -208,6 +750,24 @@ class ReplayDataReader:
             pos += command_block['size']
         return {'type': 'TIMESLOT', 'time': self.time, 'data': {'command_blocks': command_blocks}}
 
+    def iter_timeslot_actions(self):
+        if self.index is not None:
+            self.index.add(self.time, self.data.locate(self.data.tell() - 1))
+        num_bytes, time_increment = self.read("<HH")
+        self.time += time_increment
+
+        end = self.data.tell() + num_bytes - 2
+        while self.data.tell() < end:
+            player_id, actions_length = self.read("<BH")
+            if self.wanted is not None and not self.wanted:
+                self.data.skip(actions_length)
+                continue
+            block_end = self.data.tell() + actions_length
+            while self.data.tell() < block_end:
+                action = self.parse_action_block()
+                if action is not None:
+                    yield self.time, player_id, action
+
     def handleChatMessage(self):
         player_id, num_bytes, flags, mode = self.read("<BHBI")
         message = self.read_string()
@@ -219,199 +779,220 @@ class ReplayDataReader:
 
     # ACTION BLOCKS
     def handleDotaInfo(self):
+        # The same few DotA keys and item ids repeat thousands of times per
+        # game, so they are interned. Other maps (W3MMD) send free text
+        # through this action, only the DotA stat sections are interned.
         a = self.read_string()
         b = self.read_string()
         c = self.read_string()
+        if b.isdigit() or b in ('Data', 'Global'):
+            b = intern(b)
+            c = intern(c)
 
-        d = None
-        if c[0] in ['8', '9'] or c.startswith("PUI_") or c.startswith("DRI_"):
+        if c[:1] in ('8', '9') or c[:4] in ('PUI_', 'DRI_'):
             d = self.read('4s')[0][::-1].replace('\0', '') or None
+            if d is not None:
+                d = intern(d)
         else:
-            d, = self.read('L')
+            d, = self.read('<I')
 
         return {'name': 'DotaInfo', 'data': {'strings': (b, c, d)}}
 
-    def handlePauseGame(self):
-        return {'name': 'PauseGame', 'data': {}}
-
-    def handleResumeGame(self):
-        return {'name': 'ResumeGame', 'data': {}}
-
-    def handleSetGamespeed(self):
-        d = {'speed': self.read(1)}
-        return {'name': 'SetGamespeed', 'data': d}
-
-    def handleIncrGamespeed(self):
-        return {'name': 'IncreaseGamespeed', 'data': {}}
-
-    def handleDecrGamespeed(self):
-        return {'name': 'DecreaseGamespeed', 'data': {}}
-
     def handleSaveGame(self):
         d = {'name': self.read_string()}
         return {'name': 'SaveGame', 'data': d}
 
-    def handleSaveGameFinished(self):
-        self.read("I")
-        return {'name': 'SaveGameFinished', 'data': {}}
-        
-    def handleUnitAbility(self):
-        # TODO
-        self.read(14)
-        return {'name': 'UnitAbility', 'data': {}}
-
-    def handleUnitAbilityTargetPos(self):
-        # TODO
-        self.read(22)
-        return {'name': 'UnitAbilityTargetPosition', 'data': {}}
-
-    def handleUnitAbilityTargetPosObj(self):
-        # TODO
-        self.read(30)
-        return {'name': 'UnitAbilityTargetPositionAndObject', 'data': {}}
-
-    def handleUnitAbilityTargetTwoPosObj(self):
-        # TODO
-        self.read(43)
-        return {'name': 'UnitAbilityTargetTwoPositionsAndObjects', 'data': {}}
-
-    def handleDropItem(self):
-        # TODO
-        self.read(38)
-        return {'name': 'DropItem', 'data': {}}
-
     def handleChangeSelection(self):
         # TODO
         mode, num_units = self.read("<BH")
-        for i in range(num_units):
-            obj1, obj2 = self.read("II")
+        self.data.skip(num_units * 8)
         return {'name': 'ChangeSelection', 'data': {}}
 
     def handleAssignGroupHotkey(self):
         # TODO
         group_number, num_units = self.read("<BH")
-        for i in range(num_units):
-            obj1, obj2 = self.read("II")
+        self.data.skip(num_units * 8)
         return {'name': 'AssignGroupHotkey', 'data': {}}
 
-    def handleSelectGroupHotkey(self):
-        d = dict()
-        d['group_number'] = self.read("<BB")[0]
-        return {'name': 'SelectGroupHotkey', 'data': d}
-
-    def handleSelectSubgroup(self):
-        # TODO
-        item_id, obj1, obj2 = self.read("<III")
-        return {'name': 'SelectSubgroup', 'data': {}}
-
-    def handleUpdateSubgroup(self):
-        return {'name': 'UpdateSubgroup', 'data': {}}
-
-    def handleSelectGroundItem(self):
-        # TODO
-        flags, obj1, obj2 = self.read("<BII")
-        return {'name': 'SelectGroundItem', 'data': {}}
-
-    def handleCancelHeroRevival(self):
-        # TODO
-        unit1, unit2 = self.read("<II")
-        return {'name': 'CancelHeroRevival', 'data': {}}
-
-    def handleRemoveUnitFromBuildingQueue(self):
-        # TODO
-        slot_number, unit = self.read("<BI")
-        return {'name': 'RemoveUnitFromBuildingQueue', 'data': {}}
-
-    def handleChangeAllyOptions(self):
-        # TODO
-        slot_number, flags = self.read("<BI")
-        return {'name': 'ChangeAllyOptions', 'data': {}}
-
-    def handleTransferResources(self):
-        # TODO
-        slot_number, gold, lumber = self.read("<BII")
-        return {'name': 'TransferResources', 'data': {}}
-
     def handleMapTriggerChatCommand(self):
         self.read("II")
-        self.read_string()
-        return {'name': 'MapTriggerChatCommand', 'data': {}}
-
-    def handleEscPressed(self):
-        return {'name': 'EscPressed', 'data': {}}
+        return {'name': 'MapTriggerChatCommand', 'data': {'command': self.read_string()}}
 
     def handleScenarioTrigger(self):
         self.read("III")
         return {'name': 'ScenarioTrigger', 'data': {}}
 
-    def handleEnterSkillMenu(self):
-        return {'name': 'EnterSkillMenu', 'data': {}}
-
-    def handleEnterBuildingsMenu(self):
-        return {'name': 'EnterBuildingsMenu', 'data': {}}
-
-    def handleMinimapSignal(self):
-        d = dict()
-        d['x'], d['y'] = self.read("II")
-        self.read("I")
-        return {'name': 'MinimapSignal', 'data': d}
-
-    def handleContinueGame(self):
-        self.read('IIII')
-        return {'name': 'ContinueGame', 'data': {}}
-
     def parse_action_block(self):
         a_id = self.read(1)
         #print " - ACTION BLOCK: ", repr(a_id), self.action_blocks[a_id][0]
 
         if not self.action_blocks.has_key(a_id):
-            print "Unexpected Action Block (%s)" % repr(a_id)
-            print "Next 10 Bytes: %s" % repr(self.read(10))
-            self.data.seek(self.data.tell() - 26)
-            print "Previous 10 Bytes: %s" % repr(self.read(15))
-            sys.exit()
-
-        return self.action_blocks[a_id][1]()
+            position = self.data.tell() - 1
+            raise UnknownAction(a_id, position, self.context(position))
+
+        fixed = FIXED_ACTIONS.get(a_id)
+        if fixed is not None:
+            name, fmt, fields = fixed
+            if fields and (self.wanted is None or a_id in self.wanted):
+                action = {'name': name, 'data': dict(zip(fields, self.data.unpack(fmt)))}
+            else:
+                self.data.skip(fmt.size)
+                if self.wanted is not None and a_id not in self.wanted:
+                    return None
+                action = {'name': name, 'data': {}}
+
+            if self.compact:
+                return compact_action(action)
+            return action
+
+        if self.wanted is not None and a_id not in self.wanted:
+            if ACTION_SIZES.has_key(a_id):
+                self.data.skip(ACTION_SIZES[a_id])
+            else:
+                self.action_blocks[a_id][1]()
+            return None
+
+        action = self.action_blocks[a_id][1]()
+        if self.compact and isinstance(action, dict):
+            return compact_action(action)
+        return action
 
     def parse_command_block(self):
         player_id, actions_length = self.read("<BH")
         actions = []
 
-        pos = self.data.tell()
-        end = self.data.tell() + actions_length
-        while pos < end:
-            actions.append(self.parse_action_block())
-            pos += self.data.tell() - pos
-        
-        return {'actions': actions, 'size': actions_length+3}
+        # Nothing wanted from this block, skip it as a whole
+        if self.wanted is not None and not self.wanted:
+            self.data.skip(actions_length)
+        else:
+            pos = self.data.tell()
+            end = self.data.tell() + actions_length
+            while pos < end:
+                action = self.parse_action_block()
+                if action is not None:
+                    actions.append(action)
+                pos += self.data.tell() - pos
+
+        if self.compact:
+            return CommandBlock(player_id, actions, actions_length+3)
+        return {'player_id': player_id, 'actions': actions, 'size': actions_length+3}
+
     def skip(self, n):
         return lambda: self.read(n)
 
     def read(self, length):
         if isinstance(length, str):
-            fmt = struct.Struct(length)
-            return fmt.unpack(self.data.read(fmt.size))
+            return self.data.unpack(get_struct(length))
         return self.data.read(length)
 
     def read_string(self):
-        s = ''
-        c = self.read(1)
-        while c != '\0':
-            s += c
-            c = self.read(1)
-        return s
+        return self.data.read_string()
+
+    def context(self, position):
+        # The bytes around position, as far as they are still buffered
+        context_start = max(position - 10, self.data.offset)
+        self.data.seek(context_start)
+        return self.data.read(position + 11 - context_start)
+
+    def end_of_data(self, block_id):
+        # The last data block is zero padded, so a zero block id or the end
+        # of the data ends the gamedata. Any other unknown id means a block
+        # we can't decode, and everything after it would be lost silently.
+        if block_id not in ('\0', ''):
+            position = self.data.tell() - 1
+            raise UnknownBlock(block_id, position, self.context(position))
+
+    def read_event(self):
+        block_id = self.read(1)
+        if not self.blocks.has_key(block_id):
+            self.end_of_data(block_id)
+            return None
+
+        #print "GAMEDATA BLOCK: ", repr(block_id)
+        event = self.blocks[block_id][1]()
+        if self.compact and isinstance(event, dict):
+            event = Event(event['type'], event['time'], event['data'])
+        return event
+
+    def profiled_read_event(self):
+        start, started = self.data.tell(), time.time()
+        block_id = self.read(1)
+        self.data.seek(start)
+        event = ReplayDataReader.read_event(self)
+        if event is not None:
+            self.stats.add_block(self.blocks[block_id][0], self.data.tell() - start, time.time() - started)
+        return event
+
+    def profiled_parse_action_block(self):
+        start, started = self.data.tell(), time.time()
+        a_id = self.read(1)
+        self.data.seek(start)
+        action = ReplayDataReader.parse_action_block(self)
+        name = self.action_blocks[a_id][0] if self.action_blocks.has_key(a_id) else repr(a_id)
+        self.stats.add_action(name, self.data.tell() - start, time.time() - started)
+        return action
 
-    def parse(self):
-        gamedata = []
+    def iter_events(self):
+        while True:
+            event = self.read_event()
+            if event is None:
+                return
+            yield event
+
+    def iter_actions(self):
+        # Yields (time, player_id, action) for every action without building
+        # the TimeSlot/command block lists; other blocks are decoded and dropped.
         while True:
             block_id = self.read(1)
-    
             if not self.blocks.has_key(block_id):
-                return gamedata
-                print "Unexpected Block (%s), exitting..." % repr(block_id)
-                sys.exit()
-            
-            #print "GAMEDATA BLOCK: ", repr(block_id)
-            gamedata.append(self.blocks[block_id][1]())
-
-W3Game("/home/mephory/g.w3g").parse()
+                self.end_of_data(block_id)
+                return
+
+            if self.blocks[block_id][0] in ('TimeSlot', 'TimeSlotOld'):
+                for action in self.iter_timeslot_actions():
+                    yield action
+            else:
+                self.blocks[block_id][1]()
+
+    def iter_raw_actions(self):
+        # Like iter_actions, but yields (time, player_id, action id, values)
+        # with the raw payload values of fixed-size actions instead of
+        # building an action dict for each of them.
+        while True:
+            block_id = self.read(1)
+            if not self.blocks.has_key(block_id):
+                self.end_of_data(block_id)
+                return
+            if self.blocks[block_id][0] not in ('TimeSlot', 'TimeSlotOld'):
+                self.blocks[block_id][1]()
+                continue
+
+            num_bytes, time_increment = self.read("<HH")
+            self.time += time_increment
+            end = self.data.tell() + num_bytes - 2
+            while self.data.tell() < end:
+                player_id, actions_length = self.read("<BH")
+                block_end = self.data.tell() + actions_length
+                while self.data.tell() < block_end:
+                    a_id = self.data.read(1)
+                    fixed = FIXED_ACTIONS.get(a_id)
+                    if fixed is None or (self.wanted is not None and a_id not in self.wanted):
+                        # Let parse_action_block deal with filtering, variable
+                        # length actions and unknown ids
+                        self.data.seek(self.data.tell() - 1)
+                        action = self.parse_action_block()
+                        if action is None:
+                            continue
+                        values = ()
+                        if isinstance(action, dict):
+                            values = action['data'].get('strings', ()) or tuple(action['data'].values())
+                        yield self.time, player_id, a_id, values
+                    else:
+                        yield self.time, player_id, a_id, self.data.unpack(fixed[1])
+
+    def parse(self):
+        return list(self.iter_events())
+
+if __name__ == '__main__':
+    info = W3Game(sys.argv[1]).parse()
+    print "%s: %d players, %d gamedata blocks" % (info['gameinfo']['gamename'], len(info['gameinfo']['players']), len(info['gamedata']))
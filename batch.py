@@ -0,0 +1,116 @@
+import sys
+import random
+import argparse
+import multiprocessing
+from collections import namedtuple
+
+import W3Game
+import DotaGame
+import dedup
+import util
+from cache import ReplayCache
+
+# With a ReplayError, result holds what was parsed before it. stats is a
+# W3Game.ParseStats for the sampled replays, None otherwise
+BatchResult = namedtuple('BatchResult', 'path result error stats')
+
+# The worker's ReplayCache, set once by init_worker
+_cache = None
+
+def init_worker(cache):
+    # Pool initializer. Jobs would each unpickle a fresh copy of the cache
+    # and rescan its directory to learn its size; one copy per worker keeps
+    # that estimate between replays.
+    global _cache
+    _cache = cache
+
+def parse_replay(job):
+    # timeline is the DotaGame timeline interval in ms, None for no
+    # timeline. Without a cache in the job, the worker's cache is used.
+    path, dota, cache, profile, timeline = job
+    if cache is None:
+        cache = _cache
+    stats = W3Game.ParseStats() if profile else None
+    try:
+        if cache is not None:
+            result = cache.parse(path, dota, stats, timeline)
+        elif dota:
+            result = DotaGame.DotaGame(path, stats=stats, timeline_interval=timeline)
+        else:
+            result = W3Game.W3Game(path, stats).parse()
+    except W3Game.ReplayError, e:
+        # Keeps whatever was parsed before the error
+        return BatchResult(path, e.partial, "%s: %s" % (e.__class__.__name__, e), stats)
+    except (Exception, SystemExit), e:
+        # A broken replay must never take the whole batch down with it
+        return BatchResult(path, None, "%s: %s" % (e.__class__.__name__, e), stats)
+    return BatchResult(path, result, None, stats)
+
+def parse_replays(paths, dota=False, workers=None, chunksize=1, ordered=True, cache=None, profile_rate=0.0, timeline=None):
+    # Parses every replay in paths (files or directories) on a process pool
+    # and yields a BatchResult per file, in input order unless ordered=False.
+    # A profile_rate share of the replays is parsed with ParseStats.
+    pool = multiprocessing.Pool(workers, init_worker, (cache,))
+    try:
+        jobs = ((path, dota, None, random.random() < profile_rate, timeline) for path in util.find_replays(paths))
+        if ordered:
+            results = pool.imap(parse_replay, jobs, chunksize)
+        else:
+            results = pool.imap_unordered(parse_replay, jobs, chunksize)
+        for result in results:
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+def main():
+    parser = argparse.ArgumentParser(description="Parse a directory of replays in parallel.")
+    parser.add_argument('paths', nargs='+', help="replay files or directories")
+    parser.add_argument('-w', '--workers', type=int, default=None, help="number of worker processes (default: one per core)")
+    parser.add_argument('-c', '--chunksize', type=int, default=1, help="replays handed to a worker at a time")
+    parser.add_argument('-u', '--unordered', action='store_true', help="report results as they complete")
+    parser.add_argument('-d', '--dota', action='store_true', help="aggregate DotA stats")
+    parser.add_argument('--cache', metavar='DIR', help="cache parsed replays in DIR")
+    parser.add_argument('--cache-size', type=int, default=512, help="maximum cache size in MB")
+    parser.add_argument('-t', '--timeline', type=int, default=None, metavar='MS', help="build DotA timelines with this interval")
+    parser.add_argument('--dedup', metavar='INDEX', help="parse one copy per match only, keeping the dedup index in INDEX")
+    parser.add_argument('--profile', type=float, default=0.0, metavar='RATE', help="share of replays to profile and report")
+    args = parser.parse_args()
+
+    cache = None
+    if args.cache:
+        cache = ReplayCache(args.cache, args.cache_size * 1024 * 1024)
+
+    failed = 0
+    paths = args.paths
+    if args.dedup:
+        index = dedup.DedupIndex(args.dedup)
+        paths, duplicates, errors = dedup.dedup_replays(paths, index, args.workers)
+        index.save()
+        for path, match in duplicates:
+            print "%s: duplicate of %s" % (path, match)
+        for path, error in errors:
+            failed += 1
+            print "%s: FAILED (%s)" % (path, error)
+
+    profiled = 0
+    stats = W3Game.ParseStats()
+    for path, result, error, replay_stats in parse_replays(paths, args.dota, args.workers, args.chunksize, not args.unordered, cache, args.profile, args.timeline):
+        if replay_stats is not None:
+            profiled += 1
+            stats.merge(replay_stats)
+        if error:
+            failed += 1
+            print "%s: FAILED (%s)%s" % (path, error, " with partial result" if result is not None else "")
+        elif args.dota:
+            print "%s: %s (%s)" % (path, result.gamename, ", ".join(player.name for player in result.players))
+        else:
+            print "%s: %s" % (path, result['gameinfo']['gamename'])
+    if profiled:
+        print "Profile of %d replays:" % profiled
+        print stats.report()
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
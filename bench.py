@@ -0,0 +1,252 @@
+import os
+import sys
+import time
+import shutil
+import struct
+import argparse
+import resource
+import tempfile
+import subprocess
+import multiprocessing
+
+import W3Game
+import DotaGame
+import units
+import w3gwriter
+
+# (name, setup, measured statement) for the import mode, each timed in a
+# fresh interpreter
+IMPORT_STEPS = [('import DotaGame', "", "import DotaGame"),
+                ('first lookup', "import units", "units.get('Hjai')"),
+                ('units.json', "import units", "units.build_index()")]
+
+def count_actions(events):
+    actions = 0
+    for event in events:
+        if isinstance(event, dict) and event['type'] == 'TIMESLOT':
+            for command_block in event['data']['command_blocks']:
+                actions += len(command_block['actions'])
+    return actions
+
+def bench_stages(filename, threads=None):
+    # Times every stage of a parse on its own. Runs in a fresh process so
+    # the peak RSS belongs to this replay alone.
+    stats = {'size': os.path.getsize(filename)}
+
+    start = time.time()
+    game = W3Game.W3Game(filename, threads=threads)
+    header = game.read_header()
+    stats['header'] = time.time() - start
+
+    start = time.time()
+    blocks = game.data = game.block_reader(header['num_datablocks'])
+    decompressed = 0
+    while blocks.fill():
+        decompressed += len(blocks.buffer) - blocks.pos
+        blocks.pos = len(blocks.buffer)
+    stats['decompression'] = time.time() - start
+    stats['decompressed_size'] = decompressed
+    game.close()
+
+    game = W3Game.W3Game(filename, threads=threads)
+    game.read_header()
+    game.data = game.block_reader(header['num_datablocks'])
+    start = time.time()
+    game.data.read(4)
+    game.info['gameinfo'] = game.read_gameinfo()
+    stats['gameinfo'] = time.time() - start
+
+    start = time.time()
+    stats['actions'] = count_actions(game.iter_events())
+    stats['gamedata'] = time.time() - start
+    game.close()
+
+    start = time.time()
+    W3Game.W3Game(filename, threads=threads).parse()
+    stats['parse'] = time.time() - start
+
+    start = time.time()
+    DotaGame.DotaGame(filename)
+    stats['dotagame'] = time.time() - start
+
+    stats['peak_rss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return stats
+
+class BytewiseBlockReader(W3Game.BlockReader):
+    # read_string as it was before it searched the buffer for the
+    # terminator, one read(1) per byte; the baseline for the strings mode
+    def read_string(self):
+        s = ''
+        c = self.read(1)
+        while c and c != '\0':
+            s += c
+            c = self.read(1)
+        return s
+
+class UncachedBlockReader(W3Game.BlockReader):
+    # unpack as it was before Structs were cached: a new Struct for every
+    # field, unpacked from a sliced out string; the baseline for the
+    # struct mode
+    def unpack(self, fmt):
+        return struct.Struct(fmt.format).unpack(self.read(fmt.size))
+
+def time_actions(filename, reader, runs, actions=None):
+    # Best of runs for decoding the actions of a replay through the given
+    # BlockReader class. Returns (seconds, number of actions).
+    best = None
+    for i in range(runs):
+        game = W3Game.W3Game(filename)
+        header = game.read_header()
+        game.data = reader(game.replay, header['num_datablocks'])
+        game.data.read(4)
+        game.info['gameinfo'] = game.read_gameinfo()
+        start = time.time()
+        count = sum(1 for action in game.iter_actions(actions=actions))
+        elapsed = time.time() - start
+        game.close()
+        best = elapsed if best is None else min(best, elapsed)
+    return best, count
+
+def bench_strings(filename, runs):
+    # Times decoding only the DotaInfo actions, three strings each, with
+    # the current read_string and the bytewise one
+    stats = {'size': os.path.getsize(filename)}
+    for name, reader in (('find', W3Game.BlockReader), ('bytewise', BytewiseBlockReader)):
+        stats[name], stats['actions'] = time_actions(filename, reader, runs, ['DotaInfo'])
+    return stats
+
+def bench_struct(filename, runs):
+    # Times decoding every action with the cached Structs unpacking in
+    # place and with a Struct built per field
+    stats = {'size': os.path.getsize(filename)}
+    for name, reader in (('cached', W3Game.BlockReader), ('uncached', UncachedBlockReader)):
+        stats[name], stats['actions'] = time_actions(filename, reader, runs)
+    return stats
+
+def report_struct(name, stats):
+    print "%s: %.1f MB replay, %d actions" % (name, stats['size'] / 1048576.0, stats['actions'])
+    for key in ('cached', 'uncached'):
+        print "  %-14s %8.1fms  %d actions/s" % (key, stats[key] * 1000, stats['actions'] / stats[key])
+    print "  %-14s %8.2fx" % ('speedup', stats['uncached'] / stats['cached'])
+
+def report_strings(name, stats):
+    print "%s: %.1f MB replay, %d DotaInfo actions" % (name, stats['size'] / 1048576.0, stats['actions'])
+    for key in ('find', 'bytewise'):
+        print "  %-14s %8.1fms  %d actions/s" % (key, stats[key] * 1000, stats['actions'] / stats[key])
+    print "  %-14s %8.2fx" % ('speedup', stats['bytewise'] / stats['find'])
+
+def parse_rss(filename, compact):
+    # Peak RSS growth of one parse, run in a fresh process
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    info = W3Game.W3Game(filename).parse(compact=compact)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before
+
+def bench_memory(filename, runs):
+    stats = {'size': os.path.getsize(filename)}
+    for name, compact in (('parse', False), ('compact', True)):
+        results = []
+        for i in range(runs):
+            pool = multiprocessing.Pool(1)
+            try:
+                results.append(pool.apply(parse_rss, (filename, compact)))
+            finally:
+                pool.terminate()
+                pool.join()
+        stats[name] = min(results)
+    return stats
+
+def report_memory(name, stats):
+    print "%s: %.1f MB replay" % (name, stats['size'] / 1048576.0)
+    for key in ('parse', 'compact'):
+        print "  %-14s %8.1f MB peak RSS growth" % (key, stats[key] / 1024.0)
+    if stats['compact']:
+        print "  %-14s %8.2fx" % ('saving', float(stats['parse']) / stats['compact'])
+
+def time_fresh(setup, statement):
+    code = "import time\n%s\nstart = time.time()\n%s\nprint repr(time.time() - start)" % (setup, statement)
+    output = subprocess.check_output([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)))
+    return float(output)
+
+def bench_import(runs):
+    # Best of runs for every step; the first lookup reads units.idx, so
+    # make sure it exists and is current
+    units.load_index()
+    return [(name, min(time_fresh(setup, statement) for i in range(runs))) for name, setup, statement in IMPORT_STEPS]
+
+def run_isolated(filename, threads=None):
+    pool = multiprocessing.Pool(1)
+    try:
+        return pool.apply(bench_stages, (filename, threads))
+    finally:
+        pool.terminate()
+        pool.join()
+
+def best_of(filename, runs, threads=None):
+    results = [run_isolated(filename, threads) for i in range(runs)]
+    best = dict(results[0])
+    for stats in results[1:]:
+        for key in ('header', 'decompression', 'gameinfo', 'gamedata', 'parse', 'dotagame'):
+            best[key] = min(best[key], stats[key])
+        best['peak_rss'] = min(best['peak_rss'], stats['peak_rss'])
+    return best
+
+def report(name, stats):
+    print "%s: %.1f MB replay, %.1f MB inflated, %d actions" % (name, stats['size'] / 1048576.0, stats['decompressed_size'] / 1048576.0, stats['actions'])
+    for key in ('header', 'decompression', 'gameinfo', 'gamedata', 'dotagame'):
+        print "  %-14s %8.1fms" % (key, stats[key] * 1000)
+    print "  %-14s %8.1fms  %.2f MB/s, %d actions/s" % ('full parse', stats['parse'] * 1000,
+                                                        stats['size'] / 1048576.0 / stats['parse'],
+                                                        stats['actions'] / stats['parse'])
+    print "  %-14s %8.1f MB" % ('peak RSS', stats['peak_rss'] / 1024.0)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark replay parsing on synthetic or given replays.")
+    parser.add_argument('replays', nargs='*', help="replays to benchmark instead of synthetic ones")
+    parser.add_argument('-l', '--length', type=int, default=30, help="synthetic game length in minutes")
+    parser.add_argument('-p', '--players', type=int, default=10)
+    parser.add_argument('-m', '--mix', action='append', choices=sorted(w3gwriter.MIXES), help="action mix, can be given several times (default: all)")
+    parser.add_argument('-r', '--runs', type=int, default=3, help="runs per replay, the best one is reported")
+    parser.add_argument('-t', '--threads', type=int, default=None, help="inflate data blocks on this many threads")
+    parser.add_argument('--mode', choices=['stages', 'strings', 'struct', 'import', 'memory'], default='stages',
+                        help="stages times every parse stage, strings read_string on DotaInfo actions, "
+                             "struct cached against per-field Structs, "
+                             "import the import of DotaGame and the unit data, memory the peak RSS of "
+                             "parse() against parse(compact=True) (default: stages)")
+    args = parser.parse_args()
+
+    if args.mode == 'import':
+        for name, elapsed in bench_import(args.runs):
+            print "  %-16s %8.1fms" % (name, elapsed * 1000)
+        return 0
+
+    if args.mode == 'strings':
+        # DotaInfo-heavy replays unless told otherwise
+        mixes = args.mix or ['dota']
+        bench = lambda name, filename: report_strings(name, bench_strings(filename, args.runs))
+    elif args.mode == 'struct':
+        mixes = args.mix or ['mixed']
+        bench = lambda name, filename: report_struct(name, bench_struct(filename, args.runs))
+    elif args.mode == 'memory':
+        mixes = args.mix or ['mixed']
+        bench = lambda name, filename: report_memory(name, bench_memory(filename, args.runs))
+    else:
+        mixes = args.mix or sorted(w3gwriter.MIXES)
+        bench = lambda name, filename: report(name, best_of(filename, args.runs, args.threads))
+
+    if args.replays:
+        for filename in args.replays:
+            bench(filename, filename)
+        return 0
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for mix in mixes:
+            filename = os.path.join(tmpdir, '%s.w3g' % mix)
+            w3gwriter.write_replay(filename, args.length * 60 * 1000, args.players, mix)
+            bench("%s (%d min, %d players)" % (mix, args.length, args.players), filename)
+    finally:
+        shutil.rmtree(tmpdir)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
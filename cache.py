@@ -0,0 +1,120 @@
+import os
+import errno
+import zlib
+import cPickle
+import tempfile
+
+import W3Game
+import DotaGame
+
+class ReplayCache:
+    # On-disk cache of parsed replays keyed by (header checksum, file size,
+    # parser version), so a lookup only costs a header read. Entries are
+    # compressed pickles; least recently used ones are evicted once the
+    # directory grows past max_size bytes.
+    def __init__(self, directory, max_size=512*1024*1024):
+        self.directory = directory
+        self.max_size = max_size
+        self.size = None
+        try:
+            os.makedirs(directory)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def key(self, filename, kind):
+        replay = W3Game.W3Game(filename)
+        try:
+            header = replay.read_header()
+        finally:
+            replay.close()
+        return "%08x-%d-%d.%s" % (header['checksum'], os.path.getsize(filename), W3Game.PARSER_VERSION, kind)
+
+    def get(self, filename, kind='w3g'):
+        path = os.path.join(self.directory, self.key(filename, kind))
+        try:
+            with open(path, 'rb') as f:
+                result = cPickle.loads(zlib.decompress(f.read()))
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+        except (zlib.error, cPickle.UnpicklingError, EOFError):
+            # Broken entry, e.g. from a disk that filled up mid-write
+            self.remove(path)
+            return None
+
+        # Mark as recently used for eviction
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return result
+
+    def put(self, filename, result, kind='w3g'):
+        data = zlib.compress(cPickle.dumps(result, cPickle.HIGHEST_PROTOCOL))
+
+        # Write to a temporary file and rename it into place, so concurrent
+        # workers never see a half written entry.
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.rename(tmp, os.path.join(self.directory, self.key(filename, kind)))
+        except:
+            self.remove(tmp)
+            raise
+
+        if self.size is not None:
+            self.size += len(data)
+        if self.size is None or self.size > self.max_size:
+            self.evict()
+
+    def parse(self, filename, dota=False, stats=None, timeline_interval=None):
+        kind = 'dota' if dota else 'w3g'
+        if dota and timeline_interval:
+            # Games with timelines are cached apart from those without
+            kind = 'dota-t%d' % timeline_interval
+        result = self.get(filename, kind)
+        if result is None:
+            if dota:
+                result = DotaGame.DotaGame(filename, stats=stats, timeline_interval=timeline_interval)
+            else:
+                result = W3Game.W3Game(filename, stats).parse()
+            self.put(filename, result, kind)
+        return result
+
+    def entries(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.tmp'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                # Evicted by another worker in the meantime
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+        return entries
+
+    def evict(self):
+        entries = self.entries()
+        self.size = sum(size for mtime, size, path in entries)
+        if self.size <= self.max_size:
+            return
+
+        # Evict down to 90% so we don't have to rescan on every write
+        entries.sort()
+        for mtime, size, path in entries:
+            if self.size <= self.max_size * 0.9:
+                break
+            self.remove(path)
+            self.size -= size
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
@@ -0,0 +1,128 @@
+import os
+import sys
+import hashlib
+import marshal
+import argparse
+import multiprocessing
+
+import W3Game
+import util
+
+def match_key(info):
+    # Everything every copy of a match agrees on. The header's length and
+    # the host record belong to the player who saved the replay, so they
+    # differ between copies and are left out.
+    header = info['header']
+    gameinfo = info['gameinfo']
+    players = []
+    for player in gameinfo['players']:
+        slot = player.get('slot') or {}
+        players.append((player['id'], player['name'], slot.get('team'), slot.get('color'), slot.get('race')))
+    return (header['w3_version'], header['build_number'], gameinfo['gamename'], gameinfo['random_seed'],
+            gameinfo['num_slots'], gameinfo['select_mode'], tuple(sorted(set(players))))
+
+def fingerprint(filename):
+    # Returns (fingerprint, game length in ms). Only the header and the
+    # game info are read, the gamedata blocks are never inflated.
+    info = W3Game.W3Game(filename).parse(metadata_only=True)
+    return hashlib.sha1(repr(match_key(info))).hexdigest(), info['header']['length']
+
+def read_fingerprint(path):
+    try:
+        return path, fingerprint(path), None
+    except (Exception, SystemExit), e:
+        return path, None, "%s: %s" % (e.__class__.__name__, e)
+
+class DedupIndex:
+    # Maps match fingerprints to the canonical copy of the match, the
+    # longest one seen, and links every other copy to it. Saved with
+    # marshal when a filename is given.
+    def __init__(self, filename=None):
+        self.filename = filename
+        # fingerprint -> [canonical path, length]
+        self.matches = {}
+        # path -> fingerprint
+        self.links = {}
+        if filename is not None and os.path.exists(filename):
+            with open(filename, 'rb') as f:
+                self.matches, self.links = marshal.load(f)
+
+    def add(self, path, fingerprint, length):
+        # Returns True if path is the canonical copy of its match now
+        path = os.path.abspath(path)
+        self.links[path] = fingerprint
+        match = self.matches.get(fingerprint)
+        if match is None or length > match[1] or match[0] == path:
+            self.matches[fingerprint] = [path, length]
+            return True
+        return False
+
+    def canonical(self, path):
+        fingerprint = self.links.get(os.path.abspath(path))
+        if fingerprint is None:
+            return None
+        return self.matches[fingerprint][0]
+
+    def duplicates(self, path):
+        fingerprint = self.links.get(os.path.abspath(path))
+        canonical = self.canonical(path)
+        return sorted(other for other, match in self.links.iteritems() if match == fingerprint and other != canonical)
+
+    def save(self):
+        tmp = self.filename + ".%d.tmp" % os.getpid()
+        with open(tmp, 'wb') as f:
+            marshal.dump((self.matches, self.links), f)
+        os.rename(tmp, self.filename)
+
+def dedup_replays(paths, index, workers=None):
+    # Fingerprints the replays under paths on a process pool and adds them
+    # to index. Returns (canonical paths, [(duplicate, canonical)], [(path,
+    # error)]); only the canonical copies need to be parsed.
+    pool = multiprocessing.Pool(workers)
+    try:
+        fingerprints = pool.map(read_fingerprint, list(util.find_replays(paths)))
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+    failed = []
+    added = []
+    for path, result, error in fingerprints:
+        if error:
+            failed.append((path, error))
+            continue
+        index.add(path, *result)
+        added.append(path)
+
+    canonical = []
+    duplicates = []
+    for path in added:
+        match = index.canonical(path)
+        if match == os.path.abspath(path):
+            canonical.append(path)
+        else:
+            duplicates.append((path, match))
+    return canonical, duplicates, failed
+
+def main():
+    parser = argparse.ArgumentParser(description="Find replays of the same match.")
+    parser.add_argument('paths', nargs='+', help="replay files or directories")
+    parser.add_argument('-i', '--index', help="keep the dedup index in this file across runs")
+    parser.add_argument('-w', '--workers', type=int, default=None, help="number of worker processes (default: one per core)")
+    args = parser.parse_args()
+
+    index = DedupIndex(args.index)
+    canonical, duplicates, failed = dedup_replays(args.paths, index, args.workers)
+    if args.index:
+        index.save()
+    for path in canonical:
+        print path
+    for path, match in duplicates:
+        print "%s: duplicate of %s" % (path, match)
+    for path, error in failed:
+        print "%s: FAILED (%s)" % (path, error)
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,174 @@
+import os
+import sys
+import argparse
+
+import W3Game
+import util
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+NUM_VALUES = 10
+NUM_STRINGS = 3
+
+COLUMNS = ([('replay_id', 'u4'), ('time', 'u4'), ('player_id', 'u1'), ('action_id', 'u1')] +
+           [('v%d' % i, 'f8') for i in range(NUM_VALUES)] +
+           [('s%d' % i, 'O') for i in range(NUM_STRINGS)])
+
+class ActionTable:
+    # Columnar store of per-action rows, written straight into
+    # preallocated NumPy arrays. Numeric payload values go to v0..v9
+    # (NaN when missing), strings (DotaInfo keys, chat commands) to s0..s2.
+    def __init__(self, capacity=1 << 16):
+        if numpy is None:
+            raise ImportError("numpy is required to export actions")
+        self.size = 0
+        self.capacity = capacity
+        self.columns = self.allocate(capacity)
+        self.replays = []
+
+    def allocate(self, capacity):
+        columns = {}
+        for name, dtype in COLUMNS:
+            if dtype == 'f8':
+                columns[name] = numpy.full(capacity, numpy.nan)
+            elif dtype == 'O':
+                columns[name] = numpy.full(capacity, '', dtype)
+            else:
+                columns[name] = numpy.zeros(capacity, dtype)
+        return columns
+
+    def grow(self):
+        columns = self.allocate(self.capacity * 2)
+        for name, column in self.columns.iteritems():
+            columns[name][:self.size] = column[:self.size]
+        self.columns = columns
+        self.capacity *= 2
+
+    def add_replay(self, replayfile, actions=None):
+        # A replay that raises a ReplayError leaves no rows behind
+        replay_id = len(self.replays)
+        self.replays.append(replayfile)
+        start = self.size
+
+        c = self.columns
+        values_columns = [c['v%d' % i] for i in range(NUM_VALUES)]
+        strings_columns = [c['s%d' % i] for i in range(NUM_STRINGS)]
+        game = W3Game.W3Game(replayfile)
+        try:
+            for time, player_id, a_id, values in game.iter_raw_actions(actions):
+                if self.size == self.capacity:
+                    self.grow()
+                    c = self.columns
+                    values_columns = [c['v%d' % i] for i in range(NUM_VALUES)]
+                    strings_columns = [c['s%d' % i] for i in range(NUM_STRINGS)]
+
+                row = self.size
+                c['replay_id'][row] = replay_id
+                c['time'][row] = time
+                c['player_id'][row] = player_id
+                c['action_id'][row] = ord(a_id)
+                v = s = 0
+                for value in values:
+                    if isinstance(value, str):
+                        if s < NUM_STRINGS:
+                            strings_columns[s][row] = value
+                            s += 1
+                    elif v < NUM_VALUES:
+                        values_columns[v][row] = value
+                        v += 1
+                self.size += 1
+        except W3Game.ReplayError:
+            self.clear(start)
+            self.replays.pop()
+            raise
+        finally:
+            game.close()
+        return replay_id
+
+    def clear(self, start=0):
+        # Resets the rows from start on to their empty values
+        for name, dtype in COLUMNS:
+            if dtype == 'f8':
+                self.columns[name][start:self.size].fill(numpy.nan)
+            elif dtype == 'O':
+                self.columns[name][start:self.size].fill('')
+        self.size = start
+
+    def arrays(self):
+        return dict((name, column[:self.size]) for name, column in self.columns.iteritems())
+
+    def save_npz(self, filename):
+        arrays = self.arrays()
+        for i in range(NUM_STRINGS):
+            # Keep the file loadable without allow_pickle
+            arrays['s%d' % i] = arrays['s%d' % i].astype('S')
+        arrays['replays'] = numpy.array(self.replays)
+        numpy.savez_compressed(filename, **arrays)
+
+    def save_parquet(self, filename):
+        if pyarrow is None:
+            raise ImportError("pyarrow is required to write Parquet files")
+        arrays = self.arrays()
+        names = [name for name, dtype in COLUMNS]
+        table = pyarrow.Table.from_arrays([pyarrow.array(arrays[name], from_pandas=True) for name in names], names)
+        pyarrow.parquet.write_table(table, filename)
+
+    def flush(self, filename):
+        # Writes the collected rows and starts over, for batching many
+        # replays into a series of files
+        if filename.endswith('.parquet'):
+            self.save_parquet(filename)
+        else:
+            self.save_npz(filename)
+        self.clear()
+        self.replays = []
+
+def export_replays(paths, output, batch_size=100, actions=None, format='npz'):
+    # Exports every replay under paths into output/actions-NNNN.<format>,
+    # batch_size replays per file. Replays that fail to parse are skipped.
+    # Returns (written files, [(path, error)]).
+    table = ActionTable()
+    written = []
+    failed = []
+    count = 0
+    for replayfile in util.find_replays(paths):
+        try:
+            table.add_replay(replayfile, actions)
+        except W3Game.ReplayError, e:
+            failed.append((replayfile, "%s: %s" % (e.__class__.__name__, e)))
+            continue
+        count += 1
+        if count % batch_size == 0:
+            written.append(os.path.join(output, "actions-%04d.%s" % (len(written), format)))
+            table.flush(written[-1])
+    if table.size:
+        written.append(os.path.join(output, "actions-%04d.%s" % (len(written), format)))
+        table.flush(written[-1])
+    return written, failed
+
+def main():
+    parser = argparse.ArgumentParser(description="Export replay actions to NumPy or Parquet files.")
+    parser.add_argument('paths', nargs='+', help="replay files or directories")
+    parser.add_argument('-o', '--output', default='.', help="output directory")
+    parser.add_argument('-b', '--batch-size', type=int, default=100, help="replays per output file")
+    parser.add_argument('-f', '--format', choices=('npz', 'parquet'), default='npz')
+    args = parser.parse_args()
+
+    written, failed = export_replays(args.paths, args.output, args.batch_size, format=args.format)
+    for filename in written:
+        print filename
+    for path, error in failed:
+        print "%s: FAILED (%s)" % (path, error)
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,200 @@
+import sys
+import time
+import Queue
+import argparse
+import threading
+import multiprocessing
+from collections import deque
+
+import batch
+import util
+
+class Ticket:
+    def __init__(self, path, service):
+        self.path = path
+        self.service = service
+        self.submitted = time.time()
+        self.finished = None
+        self.cancelled = False
+        self.result = None
+
+    def cancel(self):
+        # A queued replay is dropped before it reaches the pool and frees
+        # its slot; a running parse can't be interrupted, its result is
+        # dropped instead.
+        return self.service.cancel(self)
+
+    @property
+    def latency(self):
+        if self.finished is None:
+            return None
+        return self.finished - self.submitted
+
+class IngestService:
+    # Accepts replays as they are uploaded and parses them on a bounded
+    # process pool. submit() blocks once max_in_flight replays are queued
+    # or being parsed, and results() yields (ticket, BatchResult) as parses
+    # complete. Replays wait in our own queue and are handed to the pool
+    # only as workers free up, so they can still be cancelled until then.
+    def __init__(self, workers=None, max_in_flight=16, dota=False, cache=None, timeline=None):
+        self.workers = workers or multiprocessing.cpu_count()
+        self.pool = multiprocessing.Pool(self.workers, batch.init_worker, (cache,))
+        self.slots = threading.BoundedSemaphore(max_in_flight)
+        self.dota = dota
+        self.timeline = timeline
+        self.pending = deque()
+        self.running = 0
+        self.done = Queue.Queue()
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.closed = False
+        self.pool_closed = False
+
+    def submit(self, path, timeout=None):
+        # Returns a Ticket, or None if no slot freed up within timeout
+        if self.closed:
+            raise ValueError("Submit on closed IngestService")
+        if timeout is None:
+            self.slots.acquire()
+        else:
+            deadline = time.time() + timeout
+            while not self.slots.acquire(False):
+                if time.time() >= deadline:
+                    return None
+                time.sleep(0.01)
+
+        ticket = Ticket(path, self)
+        with self.lock:
+            if self.closed:
+                self.slots.release()
+                raise ValueError("Submit on closed IngestService")
+            self.pending.append(ticket)
+            self.in_flight += 1
+            self.dispatch()
+        return ticket
+
+    def dispatch(self):
+        # Hands queued tickets to the pool while workers are free; called
+        # with self.lock held
+        while self.pending and self.running < self.workers:
+            ticket = self.pending.popleft()
+            try:
+                self.pool.apply_async(batch.parse_replay, ((ticket.path, self.dota, None, False, self.timeline),),
+                                      callback=lambda result, ticket=ticket: self.finish(ticket, result))
+            except Exception, e:
+                # The pool was terminated, fail the ticket instead of
+                # leaving results() waiting for it
+                self.complete(ticket, batch.BatchResult(ticket.path, None, "%s: %s" % (e.__class__.__name__, e), None))
+                continue
+            self.running += 1
+        if self.closed and not self.pending and not self.pool_closed:
+            self.pool.close()
+            self.pool_closed = True
+
+    def cancel(self, ticket):
+        with self.lock:
+            if ticket.finished is not None:
+                return False
+            ticket.cancelled = True
+            if ticket in self.pending:
+                self.pending.remove(ticket)
+                self.complete(ticket, None)
+        return True
+
+    def complete(self, ticket, result):
+        ticket.finished = time.time()
+        ticket.result = result
+        self.slots.release()
+        self.done.put(ticket)
+
+    def finish(self, ticket, result):
+        # Runs on the pool's result thread
+        with self.lock:
+            self.running -= 1
+            self.complete(ticket, result)
+            self.dispatch()
+
+    def results(self):
+        # Yields (ticket, BatchResult) until the service is closed and
+        # everything submitted has been handed out; cancelled tickets are
+        # skipped.
+        while True:
+            with self.lock:
+                if self.closed and not self.in_flight:
+                    return
+            try:
+                ticket = self.done.get(timeout=0.1)
+            except Queue.Empty:
+                continue
+            with self.lock:
+                self.in_flight -= 1
+            if not ticket.cancelled:
+                yield ticket, ticket.result
+
+    def close(self):
+        # No more submissions, queued and running parses still complete
+        with self.lock:
+            self.closed = True
+            self.dispatch()
+
+    def terminate(self):
+        with self.lock:
+            self.closed = True
+            for ticket in list(self.pending):
+                ticket.cancelled = True
+                self.complete(ticket, None)
+            self.pending.clear()
+            self.pool_closed = True
+        self.pool.terminate()
+        self.pool.join()
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+def load_test(paths, count, workers=None, max_in_flight=16, dota=False):
+    # Floods the service with count submissions cycling through paths and
+    # reports throughput and latency percentiles.
+    replays = list(util.find_replays(paths))
+    service = IngestService(workers, max_in_flight, dota)
+
+    def feed():
+        for i in range(count):
+            service.submit(replays[i % len(replays)])
+        service.close()
+
+    start = time.time()
+    feeder = threading.Thread(target=feed)
+    feeder.daemon = True
+    feeder.start()
+
+    latencies = []
+    failed = 0
+    for ticket, result in service.results():
+        latencies.append(ticket.latency)
+        if result.error:
+            failed += 1
+    elapsed = time.time() - start
+    service.terminate()
+
+    print "%d replays in %.2fs (%.1f replays/s), %d failed" % (len(latencies), elapsed, len(latencies) / elapsed, failed)
+    for p in (50, 90, 99):
+        print "  p%d latency: %.1fms" % (p, percentile(latencies, p) * 1000)
+    print "  max latency: %.1fms" % (max(latencies) * 1000)
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the replay ingestion service.")
+    parser.add_argument('paths', nargs='+', help="replay files or directories to submit")
+    parser.add_argument('-n', '--count', type=int, default=100, help="number of submissions")
+    parser.add_argument('-w', '--workers', type=int, default=None, help="number of worker processes (default: one per core)")
+    parser.add_argument('-m', '--max-in-flight', type=int, default=16, help="maximum replays being parsed at once")
+    parser.add_argument('-d', '--dota', action='store_true', help="aggregate DotA stats")
+    args = parser.parse_args()
+
+    load_test(args.paths, args.count, args.workers, args.max_in_flight, args.dota)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,165 @@
+import os
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+
+import W3Game
+import DotaGame
+import util
+
+class Incomplete(Exception):
+    pass
+
+class LiveBlockReader(W3Game.BlockReader):
+    # BlockReader for a replay that is still being written. The block count
+    # in the header is ignored; blocks are read as long as they are complete
+    # on disk, and Incomplete is raised once the reader catches up.
+    def __init__(self, replay, position):
+        W3Game.BlockReader.__init__(self, replay, 0)
+        self.position = position
+
+    def next_block(self):
+        self.block_file_pos = self.position
+        self.replay.seek(self.position)
+        header = self.replay.read(W3Game.BLOCK_HEADER.size)
+        if len(header) < W3Game.BLOCK_HEADER.size:
+            raise Incomplete()
+        compressed_size, decompressed_size, checksum = W3Game.BLOCK_HEADER.unpack(header)
+        data = self.replay.read(compressed_size)
+        if len(data) < compressed_size:
+            raise Incomplete()
+
+        self.position += W3Game.BLOCK_HEADER.size + compressed_size
+        return self.inflate(data)
+
+class LiveReplay:
+    # Incremental parser for a replay that is being written. Every poll()
+    # decodes only the blocks appended since the last one and returns the
+    # new events; self.stats is kept up to date for DotA games.
+    def __init__(self, filename, actions=None, dota=True):
+        self.replayfile = filename
+        self.actions = actions
+        self.dota = dota
+        self.game = None
+        self.reader = None
+        self.stats = None
+        self.info = None
+        self.finished = False
+
+    def start(self):
+        if os.path.getsize(self.replayfile) < W3Game.HEADER.size:
+            return False
+
+        game = W3Game.W3Game(self.replayfile)
+        header = game.read_header()
+        game.data = LiveBlockReader(game.replay, game.replay.tell())
+        game.data.mark = 0
+        try:
+            game.data.read(4)
+            gameinfo = game.read_gameinfo()
+        except Incomplete:
+            game.close()
+            return False
+
+        self.game = game
+        self.info = {'header': header, 'gameinfo': gameinfo}
+        self.reader = W3Game.ReplayDataReader(game.data, self.actions)
+        if self.dota:
+            self.stats = DotaGame.DotaGame(self.replayfile, self.info)
+        return True
+
+    def poll(self):
+        if self.finished or (self.game is None and not self.start()):
+            return []
+
+        events = []
+        data = self.game.data
+        while True:
+            # Remember where the event starts, so it can be decoded again
+            # once the rest of it has been written.
+            data.mark = data.tell()
+            current_time = self.reader.time
+            try:
+                event = self.reader.read_event()
+            except Incomplete:
+                data.seek(data.mark)
+                self.reader.time = current_time
+                break
+
+            if event is None:
+                self.finished = True
+                self.game.close()
+                break
+            events.append(event)
+            if self.stats is not None:
+                self.stats.feed(event)
+
+        if events and self.stats is not None:
+            self.stats.update_players()
+        return events
+
+    def follow(self, interval=1.0):
+        while not self.finished:
+            events = self.poll()
+            if events or self.finished:
+                yield events
+            else:
+                time.sleep(interval)
+
+def simulate_writer(source, target, interval=0.5, blocks_per_step=1):
+    # Test harness: copies an existing replay to target a few blocks at a
+    # time, the way the game writes a replay while it is running.
+    src = open(source, 'rb')
+    header = W3Game.HEADER.unpack(src.read(W3Game.HEADER.size))
+    with open(target, 'wb') as dst:
+        src.seek(0)
+        dst.write(src.read(header[1]))
+        dst.flush()
+        while True:
+            for i in range(blocks_per_step):
+                block_header = src.read(W3Game.BLOCK_HEADER.size)
+                if not block_header:
+                    src.close()
+                    return
+                compressed_size = W3Game.BLOCK_HEADER.unpack(block_header)[0]
+                block = block_header + src.read(compressed_size)
+                # Write blocks in two halves to exercise partially written blocks
+                dst.write(block[:len(block) / 2])
+                dst.flush()
+                time.sleep(interval / 10)
+                dst.write(block[len(block) / 2:])
+                dst.flush()
+            time.sleep(interval)
+
+def main():
+    parser = argparse.ArgumentParser(description="Follow a replay while it is being written.")
+    parser.add_argument('replay', help="replay file to follow, or the source replay with --simulate")
+    parser.add_argument('-i', '--interval', type=float, default=1.0, help="seconds between polls")
+    parser.add_argument('--simulate', action='store_true', help="replay the given file into a temporary file block by block and follow that")
+    args = parser.parse_args()
+
+    filename = args.replay
+    if args.simulate:
+        tmpdir = tempfile.mkdtemp()
+        filename = os.path.join(tmpdir, 'live.w3g')
+        open(filename, 'wb').close()
+        writer = threading.Thread(target=simulate_writer, args=(args.replay, filename, args.interval / 2))
+        writer.daemon = True
+        writer.start()
+
+    replay = LiveReplay(filename)
+    total = 0
+    try:
+        for events in replay.follow(args.interval):
+            total += len(events)
+            print "%s: %d new events (%d total, game time %s)" % (time.strftime("%H:%M:%S"), len(events), total, util.convert_time(replay.reader.time))
+            for player in replay.stats.players:
+                print "  %-15s %s/%s/%s" % (player.name, player.kills, player.deaths, player.assists)
+    finally:
+        if args.simulate:
+            shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,176 @@
+import os
+import sys
+import json
+import zlib
+import errno
+import hashlib
+import cPickle
+import argparse
+import multiprocessing
+
+import W3Game
+import batch
+import util
+
+# Entry states: done has a full result, partial the result up to a
+# ReplayError, failed none at all
+DONE, PARTIAL, FAILED = 'done', 'partial', 'failed'
+
+def manifest_path(path):
+    # Entries are keyed by absolute unicode paths, the type json gives back.
+    # Decoding doesn't depend on the locale, so keys stay the same across
+    # runs; names that aren't UTF-8 still map to one key each via latin-1.
+    path = os.path.abspath(path)
+    if isinstance(path, str):
+        try:
+            path = path.decode('utf-8')
+        except UnicodeDecodeError:
+            path = path.decode('latin-1')
+    return path
+
+def read_checksum(path):
+    game = W3Game.W3Game(path)
+    try:
+        return game.read_header()['checksum']
+    finally:
+        game.close()
+
+class Manifest:
+    # Durable record of a batch run: one JSON line per finished replay with
+    # its state, size, header checksum and result file, appended and synced
+    # as soon as the replay is done. A crash loses at most the line being
+    # written; later lines for a path override earlier ones.
+    def __init__(self, filename):
+        self.filename = filename
+        self.entries = {}
+        torn = False
+        if os.path.exists(filename):
+            with open(filename) as f:
+                for line in f:
+                    torn = not line.endswith("\n")
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Torn last line of a crashed run
+                        continue
+                    self.entries[entry['path']] = entry
+        self.journal = open(filename, 'a')
+        if torn:
+            # Keep the next entry off the torn line
+            self.journal.write("\n")
+
+    def record(self, entry):
+        self.entries[entry['path']] = entry
+        self.journal.write(json.dumps(entry, sort_keys=True) + "\n")
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+
+    def is_complete(self, path, retry_failed=False):
+        # A replay is skipped if it was finished and hasn't changed since
+        entry = self.entries.get(manifest_path(path))
+        if entry is None or (retry_failed and entry['state'] != DONE):
+            return False
+        try:
+            if os.path.getsize(path) != entry['size']:
+                return False
+            return entry['checksum'] is None or read_checksum(path) == entry['checksum']
+        except (OSError, IOError):
+            return False
+
+    def summary(self):
+        counts = dict.fromkeys((DONE, PARTIAL, FAILED), 0)
+        for entry in self.entries.itervalues():
+            counts[entry['state']] += 1
+        return counts
+
+    def close(self):
+        self.journal.close()
+
+def result_path(output, path):
+    return os.path.join(output, hashlib.sha1(manifest_path(path).encode('utf-8')).hexdigest() + ".pkl")
+
+def process_replay(job):
+    # Runs on the pool: parses the replay, writes the result next to the
+    # others and returns the manifest entry
+    path, output, dota, timeline = job
+    path = os.path.abspath(path)
+    output = os.path.abspath(output)
+    entry = {'path': manifest_path(path), 'size': None, 'checksum': None, 'result': None, 'error': None}
+    try:
+        entry['size'] = os.path.getsize(path)
+        entry['checksum'] = read_checksum(path)
+    except Exception:
+        # Unreadable header, the parse below reports why
+        pass
+
+    path, result, error, stats = batch.parse_replay((path, dota, None, False, timeline))
+    entry['error'] = error
+    if error is None:
+        entry['state'] = DONE
+    elif result is not None:
+        entry['state'] = PARTIAL
+    else:
+        entry['state'] = FAILED
+        return entry
+
+    filename = result_path(output, path)
+    tmp = filename + ".%d.tmp" % os.getpid()
+    with open(tmp, 'wb') as f:
+        f.write(zlib.compress(cPickle.dumps(result, 2)))
+    os.rename(tmp, filename)
+    entry['result'] = filename
+    return entry
+
+def load_result(entry):
+    with open(entry['result'], 'rb') as f:
+        return cPickle.loads(zlib.decompress(f.read()))
+
+def run(paths, manifest, output, dota=False, workers=None, retry_failed=False, timeline=None):
+    # Parses every replay under paths that the manifest doesn't have as
+    # complete, recording each one as it finishes. Returns the number of
+    # replays parsed in this run.
+    try:
+        os.makedirs(output)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+
+    jobs = [(path, output, dota, timeline) for path in util.find_replays(paths)
+            if not manifest.is_complete(path, retry_failed)]
+    if not jobs:
+        return 0
+
+    pool = multiprocessing.Pool(workers)
+    try:
+        for entry in pool.imap_unordered(process_replay, jobs):
+            manifest.record(entry)
+            if entry['error']:
+                print "%s: %s (%s)" % (entry['path'].encode('utf-8'), entry['state'].upper(), entry['error'])
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    return len(jobs)
+
+def main():
+    parser = argparse.ArgumentParser(description="Parse an archive of replays, resuming where the last run stopped.")
+    parser.add_argument('paths', nargs='+', help="replay files or directories")
+    parser.add_argument('-m', '--manifest', required=True, help="manifest file recording the finished replays")
+    parser.add_argument('-o', '--output', required=True, help="directory for the parsed results")
+    parser.add_argument('-w', '--workers', type=int, default=None, help="number of worker processes (default: one per core)")
+    parser.add_argument('-d', '--dota', action='store_true', help="aggregate DotA stats")
+    parser.add_argument('-t', '--timeline', type=int, default=None, metavar='MS', help="build DotA timelines with this interval")
+    parser.add_argument('--retry-failed', action='store_true', help="parse failed and partial replays again")
+    args = parser.parse_args()
+
+    manifest = Manifest(args.manifest)
+    try:
+        parsed = run(args.paths, manifest, args.output, args.dota, args.workers, args.retry_failed, args.timeline)
+    finally:
+        manifest.close()
+    counts = manifest.summary()
+    print "%d replays parsed in this run; %d done, %d partial, %d failed overall" % (parsed, counts[DONE], counts[PARTIAL], counts[FAILED])
+    return 1 if counts[FAILED] or counts[PARTIAL] else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
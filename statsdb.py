@@ -0,0 +1,192 @@
+import os
+import sys
+import time
+import sqlite3
+import argparse
+
+import batch
+import util
+
+DAY = 24 * 60 * 60
+
+# Per-game counters, summed into the totals and history tables
+COUNTERS = ['kills', 'deaths', 'assists', 'ckills', 'cdenies', 'cneutrals', 'towers', 'purchases']
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS replays (
+    id INTEGER PRIMARY KEY,
+    key TEXT UNIQUE NOT NULL,
+    gamename TEXT,
+    mode TEXT,
+    played INTEGER
+);
+CREATE TABLE IF NOT EXISTS games (
+    replay_id INTEGER NOT NULL REFERENCES replays(id),
+    player TEXT NOT NULL,
+    hero TEXT,
+    %(columns)s
+);
+CREATE INDEX IF NOT EXISTS games_player ON games(player);
+CREATE INDEX IF NOT EXISTS games_hero ON games(hero);
+CREATE TABLE IF NOT EXISTS player_totals (
+    player TEXT PRIMARY KEY,
+    games INTEGER NOT NULL DEFAULT 0,
+    %(columns)s
+);
+CREATE TABLE IF NOT EXISTS hero_totals (
+    hero TEXT PRIMARY KEY,
+    games INTEGER NOT NULL DEFAULT 0,
+    %(columns)s
+);
+CREATE TABLE IF NOT EXISTS player_history (
+    player TEXT NOT NULL,
+    bucket INTEGER NOT NULL,
+    games INTEGER NOT NULL DEFAULT 0,
+    %(columns)s,
+    PRIMARY KEY (player, bucket)
+);
+""" % {'columns': ",\n    ".join("%s INTEGER NOT NULL DEFAULT 0" % name for name in COUNTERS)}
+
+def counter(value):
+    # Stats that never showed up in the replay are left as []
+    return value if isinstance(value, (int, long)) else 0
+
+def player_counters(player):
+    values = [counter(getattr(player, name)) for name in COUNTERS[:-1]]
+    values.append(sum(1 for entry in player.item_log if entry['action'] == 'purchase'))
+    return values
+
+class StatsStore:
+    # SQLite store of per-player and per-hero totals across replays. Every
+    # DotaGame is added once; the totals and the per-bucket history are
+    # updated in the same transaction, so leaderboard queries are lookups
+    # on small indexed tables instead of reparsing replays.
+    def __init__(self, filename, bucket_size=DAY):
+        self.db = sqlite3.connect(filename)
+        # Names come from the replays as byte strings in whatever encoding
+        # the game used; store and return them as they are
+        self.db.text_factory = str
+        self.db.executescript(SCHEMA)
+        self.bucket_size = bucket_size
+
+    def has_replay(self, key):
+        return self.db.execute("SELECT 1 FROM replays WHERE key = ?", (key,)).fetchone() is not None
+
+    def add_game(self, game, key=None, played=None):
+        # key identifies the replay, the file name by default, and must be
+        # given for replays parsed from memory; played is the unix time the
+        # game was played, the file's mtime by default, now for replays
+        # from memory. Returns False if the replay was added before.
+        if key is None:
+            if game.replayfile is None:
+                raise ValueError("A key is required for a replay without a file name")
+            key = os.path.abspath(game.replayfile)
+        if played is None:
+            played = os.path.getmtime(game.replayfile) if game.replayfile is not None else time.time()
+        bucket = int(played) // self.bucket_size * self.bucket_size
+
+        with self.db:
+            try:
+                cursor = self.db.execute("INSERT INTO replays (key, gamename, mode, played) VALUES (?, ?, ?, ?)",
+                                         (key, game.gamename, game.mode, int(played)))
+            except sqlite3.IntegrityError:
+                return False
+            replay_id = cursor.lastrowid
+
+            for player in game.players:
+                hero = player.hero.id if player.hero is not None else None
+                values = player_counters(player)
+                self.db.execute("INSERT INTO games VALUES (?, ?, ?, %s)" % ", ".join("?" * len(COUNTERS)),
+                                [replay_id, player.name, hero] + values)
+                self.add_totals('player_totals', ['player'], [player.name], values)
+                self.add_totals('player_history', ['player', 'bucket'], [player.name, bucket], values)
+                if hero is not None:
+                    self.add_totals('hero_totals', ['hero'], [hero], values)
+        return True
+
+    def add_totals(self, table, keys, key_values, values):
+        where = " AND ".join("%s = ?" % key for key in keys)
+        self.db.execute("INSERT OR IGNORE INTO %s (%s) VALUES (%s)" % (table, ", ".join(keys), ", ".join("?" * len(keys))), key_values)
+        self.db.execute("UPDATE %s SET games = games + 1, %s WHERE %s" % (table, ", ".join("%s = %s + ?" % (name, name) for name in COUNTERS), where),
+                        values + key_values)
+
+    def rows(self, sql, args=()):
+        cursor = self.db.execute(sql, args)
+        names = [column[0] for column in cursor.description]
+        return [dict(zip(names, row)) for row in cursor]
+
+    def player(self, name):
+        rows = self.rows("SELECT * FROM player_totals WHERE player = ?", (name,))
+        return rows[0] if rows else None
+
+    def hero(self, hero_id):
+        rows = self.rows("SELECT * FROM hero_totals WHERE hero = ?", (hero_id,))
+        return rows[0] if rows else None
+
+    def history(self, name):
+        return self.rows("SELECT * FROM player_history WHERE player = ? ORDER BY bucket", (name,))
+
+    def player_heroes(self, name):
+        # Totals per hero for one player
+        return self.rows("SELECT hero, COUNT(*) AS games, %s FROM games WHERE player = ? GROUP BY hero ORDER BY games DESC" %
+                         ", ".join("SUM(%s) AS %s" % (name, name) for name in COUNTERS), (name,))
+
+    def leaderboard(self, stat='kills', limit=10, min_games=1):
+        if stat not in COUNTERS and stat != 'games':
+            raise ValueError("Unknown stat %r" % stat)
+        return self.rows("SELECT * FROM player_totals WHERE games >= ? ORDER BY %s DESC LIMIT ?" % stat, (min_games, limit))
+
+    def close(self):
+        self.db.close()
+
+def add_replays(store, paths, workers=None):
+    # Parses the replays not in the store yet on a process pool and adds
+    # them. Returns (added, failed).
+    paths = [path for path in util.find_replays(paths) if not store.has_replay(os.path.abspath(path))]
+    added = failed = 0
+    for path, result, error, stats in batch.parse_replays(paths, dota=True, workers=workers, ordered=False):
+        if error:
+            failed += 1
+            print "%s: FAILED (%s)" % (path, error)
+        elif store.add_game(result):
+            added += 1
+    return added, failed
+
+def main():
+    parser = argparse.ArgumentParser(description="Keep player and hero totals across DotA replays.")
+    parser.add_argument('database')
+    subparsers = parser.add_subparsers(dest='command')
+    add = subparsers.add_parser('add', help="add replays")
+    add.add_argument('paths', nargs='+', help="replay files or directories")
+    add.add_argument('-w', '--workers', type=int, default=None, help="number of worker processes (default: one per core)")
+    top = subparsers.add_parser('top', help="show a leaderboard")
+    top.add_argument('stat', nargs='?', default='kills', choices=COUNTERS + ['games'])
+    top.add_argument('-n', '--limit', type=int, default=10)
+    top.add_argument('-m', '--min-games', type=int, default=1)
+    player = subparsers.add_parser('player', help="show a player's totals and heroes")
+    player.add_argument('name')
+    args = parser.parse_args()
+
+    store = StatsStore(args.database)
+    try:
+        if args.command == 'add':
+            added, failed = add_replays(store, args.paths, args.workers)
+            print "%d replays added, %d failed" % (added, failed)
+            return 1 if failed else 0
+
+        if args.command == 'top':
+            rows = store.leaderboard(args.stat, args.limit, args.min_games)
+        else:
+            totals = store.player(args.name)
+            if totals is None:
+                print "Unknown player %s" % args.name
+                return 1
+            rows = [totals] + store.player_heroes(args.name)
+        for row in rows:
+            print "  %-20s %s" % (row.get('player') or row.get('hero'), " ".join("%s=%s" % (name, row[name]) for name in ['games'] + COUNTERS))
+        return 0
+    finally:
+        store.close()
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,91 @@
+import struct
+import bisect
+
+import W3Game
+
+INDEX_HEADER = struct.Struct("<4sIIII")
+INDEX_ENTRY = struct.Struct("<IIII")
+
+class TimeIndex:
+    # Sidecar index mapping game time to the position of a TimeSlot block:
+    # (time before the slot, data block number, file position of that
+    # block, offset inside the inflated block). One entry is kept per
+    # interval ms of game time.
+    def __init__(self, interval=10000, checksum=None):
+        self.interval = interval
+        self.checksum = checksum
+        self.times = []
+        self.entries = []
+
+    def add(self, time, location):
+        if self.times and time < self.times[-1] + self.interval:
+            return
+        self.times.append(time)
+        self.entries.append((time,) + location)
+
+    def lookup(self, time):
+        # Last entry strictly before time, since a TimeSlot starting at
+        # time - increment already carries events stamped with time
+        if not self.entries:
+            raise ValueError("Empty time index")
+        i = bisect.bisect_left(self.times, time)
+        return self.entries[max(i - 1, 0)]
+
+    def save(self, filename):
+        with open(filename, 'wb') as f:
+            f.write(INDEX_HEADER.pack('W3TI', 1, self.checksum, self.interval, len(self.entries)))
+            for entry in self.entries:
+                f.write(INDEX_ENTRY.pack(*entry))
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename, 'rb') as f:
+            magic, version, checksum, interval, count = INDEX_HEADER.unpack(f.read(INDEX_HEADER.size))
+            if magic != 'W3TI' or version != 1:
+                raise ValueError("%s is not a time index" % filename)
+            index = cls(interval, checksum)
+            data = f.read(INDEX_ENTRY.size * count)
+        for i in range(count):
+            entry = INDEX_ENTRY.unpack_from(data, i * INDEX_ENTRY.size)
+            index.times.append(entry[0])
+            index.entries.append(entry)
+        return index
+
+def index_path(replayfile):
+    return replayfile + ".idx"
+
+def build(replayfile, interval=10000):
+    # Full parse that records the index and writes it next to the replay
+    game = W3Game.W3Game(replayfile)
+    index = TimeIndex(interval)
+    for event in game.iter_events(actions=[], index=index):
+        pass
+    game.close()
+    index.checksum = game.info['header']['checksum']
+    index.save(index_path(replayfile))
+    return index
+
+def load(replayfile, interval=10000):
+    # Loads the sidecar index of a replay, building it if there is none, it
+    # is corrupt or cut short, or it belongs to a replay since replaced
+    try:
+        index = TimeIndex.load(index_path(replayfile))
+    except (IOError, struct.error, ValueError):
+        return build(replayfile, interval)
+
+    game = W3Game.W3Game(replayfile)
+    try:
+        checksum = game.read_header()['checksum']
+    finally:
+        game.close()
+    if index.checksum != checksum:
+        return build(replayfile, interval)
+    return index
+
+def iter_events_between(replayfile, start, end, actions=None, compact=False):
+    game = W3Game.W3Game(replayfile)
+    try:
+        for event in game.iter_events_between(start, end, load(replayfile), actions, compact):
+            yield event
+    finally:
+        game.close()
@@ -0,0 +1,58 @@
+import os
+import json
+import marshal
+from collections import namedtuple
+
+UNITS_JSON = os.path.join(os.path.dirname(os.path.abspath(__file__)), "units.json")
+UNITS_INDEX = os.path.join(os.path.dirname(os.path.abspath(__file__)), "units.idx")
+
+Unit = namedtuple('Unit', 'id name proper_name icon type cost')
+
+_index = None
+
+def build_index():
+    # Flatten units.json into id -> (name, proper name, icon, type, cost)
+    # tuples, which marshal loads much faster than json builds the dicts.
+    index = {}
+    for unit_id, unit in json.loads(open(UNITS_JSON).read()).iteritems():
+        proper_names = unit.get('ProperNames')
+        cost = unit.get('Cost')
+        index[str(unit_id)] = (str(unit['Name']),
+                               str(proper_names[0]) if proper_names else None,
+                               str(unit['Image'][:-4] + ".png"),
+                               str(unit['Type']),
+                               int(cost) if cost else None)
+    return index
+
+def load_index():
+    try:
+        if os.path.getmtime(UNITS_INDEX) >= os.path.getmtime(UNITS_JSON):
+            with open(UNITS_INDEX, 'rb') as f:
+                return marshal.load(f)
+    except (OSError, IOError, EOFError, ValueError, TypeError):
+        pass
+
+    index = build_index()
+    # Best effort, the package directory might not be writable
+    try:
+        tmp = UNITS_INDEX + ".%d.tmp" % os.getpid()
+        with open(tmp, 'wb') as f:
+            marshal.dump(index, f)
+        os.rename(tmp, UNITS_INDEX)
+    except (OSError, IOError):
+        pass
+    return index
+
+def get(unit_id):
+    global _index
+    if _index is None:
+        _index = load_index()
+    unit = _index.get(unit_id)
+    if unit is None:
+        return None
+    return Unit(unit_id, *unit)
+
+if __name__ == '__main__':
+    # Rebuild the index, e.g. after updating units.json
+    with open(UNITS_INDEX, 'wb') as f:
+        marshal.dump(build_index(), f)
@@ -1,6 +1,20 @@
+import os
 import time
 
 def convert_time(t):
     minute = int(t/60000)
     second = int((t%60000)/1000)
     return "%02d:%02d" % (minute, second)
+
+def find_replays(paths):
+    if isinstance(paths, basestring):
+        paths = [paths]
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                if name.lower().endswith('.w3g'):
+                    yield os.path.join(root, name)
@@ -0,0 +1,178 @@
+import sys
+import zlib
+import random
+import struct
+import argparse
+
+import W3Game
+
+BLOCK_SIZE = 8192
+TIMESLOT_INTERVAL = 100
+
+# Relative weights of the generated actions per mix
+MIXES = {'selection': {'ChangeSelection': 6, 'UnitAbility': 2, 'UnitAbilityTargetPos': 1, 'SelectSubgroup': 1, 'DotaInfo': 1},
+         'dota':      {'DotaInfo': 7, 'ChangeSelection': 1, 'UnitAbility': 1, 'EscPressed': 1},
+         'chat':      {'UnitAbility': 2, 'ChangeSelection': 2, 'DotaInfo': 1, 'MapTriggerChatCommand': 1},
+         'mixed':     {'ChangeSelection': 3, 'DotaInfo': 3, 'UnitAbility': 2, 'UnitAbilityTargetPos': 1,
+                       'SelectSubgroup': 1, 'MinimapSignal': 1, 'EscPressed': 1, 'UpdateSubgroup': 1,
+                       'MapTriggerChatCommand': 1}}
+
+# Share of timeslots preceded by a chat message
+CHAT_RATES = {'selection': 0.01, 'dota': 0.02, 'chat': 0.3, 'mixed': 0.05}
+
+ITEMS = ['I04M', 'I04L']
+HEROES = ['EC57']
+
+def cstring(s):
+    return s + '\0'
+
+def dota_id(player_id):
+    # Slot colors skip 6, the Scourge
+    return player_id if player_id <= 5 else player_id + 1
+
+class ReplayWriter:
+    # Writes synthetic but well-formed replays: header, game info and zlib
+    # compressed data blocks with a configurable length, player count and
+    # action mix. Used for benchmarks and tests. With late_heroes the heroes
+    # are only reported in a final timeslot, the way DotA does it.
+    def __init__(self, players=10, mix='mixed', seed=0, late_heroes=False):
+        if not MIXES.has_key(mix):
+            raise ValueError("Unknown action mix %r" % mix)
+        self.players = players
+        self.mix = mix
+        self.seed = seed
+        self.late_heroes = late_heroes
+        self.random = random.Random(seed)
+        self.weights = sorted(MIXES[mix].items())
+        self.total_weight = sum(weight for name, weight in self.weights)
+
+    def gameinfo(self):
+        data = ['\0\0\0\0']
+        data.append('\x00' + chr(1) + cstring('Player1') + '\x01\x00')
+        data.append(cstring('Synthetic game') + '\x00' + cstring('\x01\x03\x05settings'))
+        data.append(struct.pack('<I', self.players))
+        data.append(struct.pack('<BBHI', 9, 0, 0, 0x18f))
+        for player_id in range(2, self.players + 1):
+            data.append('\x16' + chr(player_id) + cstring('Player%d' % player_id) + '\x01\x00' + struct.pack('<I', 0))
+
+        slots = ''
+        for player_id in range(1, self.players + 1):
+            team = 0 if player_id <= 5 else 1
+            slots += struct.pack('<9B', player_id, 100, 2, 0, team, dota_id(player_id), 0x20, 1, 100)
+        # The game's random seed, so replays of different seeds count as
+        # different matches
+        start = chr(self.players) + slots + struct.pack('<I', self.seed & 0xffffffff) + '\x00' + chr(self.players)
+        data.append('\x19' + struct.pack('<H', len(start)) + start)
+        return ''.join(data)
+
+    def dotainfo(self, section, key, value):
+        action = '\x6B' + cstring('dr.x') + cstring(section) + cstring(key)
+        if isinstance(value, str):
+            return action + value[::-1]
+        return action + struct.pack('<I', value)
+
+    def random_dotainfo(self):
+        rnd = self.random
+        player = dota_id(rnd.randint(1, self.players))
+        kind = rnd.randint(0, 6)
+        if kind == 0:
+            return self.dotainfo('Data', 'PUI_%d' % player, rnd.choice(ITEMS))
+        elif kind == 1:
+            return self.dotainfo('Data', 'Hero%d' % player, dota_id(rnd.randint(1, self.players)))
+        elif kind == 2:
+            return self.dotainfo(str(player), rnd.choice('1234567'), rnd.randint(0, 20))
+        elif kind == 3 and not self.late_heroes:
+            return self.dotainfo(str(player), '9', rnd.choice(HEROES))
+        elif kind == 4:
+            return self.dotainfo(str(player), '8_%d' % rnd.randint(0, 5), rnd.choice(ITEMS))
+        elif kind == 5:
+            return self.dotainfo('Data', 'Assist%d' % player, dota_id(rnd.randint(1, self.players)))
+        return self.dotainfo('Data', 'Tower010', player)
+
+    def action(self):
+        rnd = self.random
+        pick = rnd.uniform(0, self.total_weight)
+        for name, weight in self.weights:
+            pick -= weight
+            if pick <= 0:
+                break
+
+        if name == 'ChangeSelection':
+            num_units = rnd.randint(1, 12)
+            return '\x16' + struct.pack('<BH', 1, num_units) + struct.pack('<II', 0x1000, 0x2000) * num_units
+        elif name == 'DotaInfo':
+            return self.random_dotainfo()
+        elif name == 'UnitAbility':
+            return '\x10' + struct.pack('<HIII', 0x40, 0xD0003, 0, 0)
+        elif name == 'UnitAbilityTargetPos':
+            return '\x11' + struct.pack('<HIIIff', 0x40, 0xD0012, 0, 0, rnd.uniform(-8000, 8000), rnd.uniform(-8000, 8000))
+        elif name == 'SelectSubgroup':
+            return '\x19' + struct.pack('<III', 0x6F707573, 0x1000, 0x2000)
+        elif name == 'MinimapSignal':
+            return '\x68' + struct.pack('<ffI', rnd.uniform(-8000, 8000), rnd.uniform(-8000, 8000), 0)
+        elif name == 'MapTriggerChatCommand':
+            return '\x60' + struct.pack('<II', 0, 0) + cstring('-ap')
+        elif name == 'EscPressed':
+            return '\x61'
+        return '\x1A'
+
+    def gamedata(self, length):
+        rnd = self.random
+        data = []
+        for time in range(0, length, TIMESLOT_INTERVAL):
+            if rnd.random() < CHAT_RATES[self.mix]:
+                message = cstring('message at %d' % time)
+                data.append('\x20' + struct.pack('<BHBI', rnd.randint(1, self.players), len(message) + 5, 0x20, 0) + message)
+
+            command_blocks = ''
+            for i in range(rnd.randint(0, 3)):
+                actions = ''.join(self.action() for j in range(rnd.randint(1, 4)))
+                command_blocks += struct.pack('<BH', rnd.randint(1, self.players), len(actions)) + actions
+            data.append('\x1F' + struct.pack('<HH', len(command_blocks) + 2, TIMESLOT_INTERVAL) + command_blocks)
+
+        if self.late_heroes:
+            command_blocks = ''
+            for player_id in range(1, self.players + 1):
+                action = self.dotainfo(str(dota_id(player_id)), '9', rnd.choice(HEROES))
+                command_blocks += struct.pack('<BH', player_id, len(action)) + action
+            data.append('\x1F' + struct.pack('<HH', len(command_blocks) + 2, 0) + command_blocks)
+
+        for player_id in range(1, self.players + 1):
+            data.append('\x17' + struct.pack('<IBII', 1, player_id, 9, 0))
+        return ''.join(data)
+
+    def replay(self, length):
+        # Returns the bytes of a replay of length ms of game time
+        data = self.gameinfo() + self.gamedata(length)
+        data += '\0' * (-len(data) % BLOCK_SIZE)
+
+        blocks = []
+        for i in range(0, len(data), BLOCK_SIZE):
+            compressed = zlib.compress(data[i:i + BLOCK_SIZE])
+            blocks.append(W3Game.BLOCK_HEADER.pack(len(compressed), BLOCK_SIZE, 0) + compressed)
+        body = ''.join(blocks)
+
+        header = W3Game.HEADER.pack('Warcraft III recorded game\x1A\0', W3Game.HEADER.size,
+                                    W3Game.HEADER.size + len(body), 1, len(data), len(blocks),
+                                    'PX3W', 26, 6059, 0x8000, length, zlib.crc32(body) & 0xffffffff)
+        return header + body
+
+def write_replay(filename, length=30 * 60 * 1000, players=10, mix='mixed', seed=0, late_heroes=False):
+    with open(filename, 'wb') as f:
+        f.write(ReplayWriter(players, mix, seed, late_heroes).replay(length))
+
+def main():
+    parser = argparse.ArgumentParser(description="Write a synthetic replay.")
+    parser.add_argument('filename')
+    parser.add_argument('-l', '--length', type=int, default=30, help="game length in minutes")
+    parser.add_argument('-p', '--players', type=int, default=10)
+    parser.add_argument('-m', '--mix', choices=sorted(MIXES), default='mixed')
+    parser.add_argument('-s', '--seed', type=int, default=0)
+    parser.add_argument('--late-heroes', action='store_true', help="report heroes only at the end of the game")
+    args = parser.parse_args()
+
+    write_replay(args.filename, args.length * 60 * 1000, args.players, args.mix, args.seed, args.late_heroes)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())